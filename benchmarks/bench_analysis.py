@@ -0,0 +1,130 @@
+"""
+Benchmark the post-parse analysis stage: row-by-row (the old way) against vectorized.
+
+DNS and SPF lookups are stubbed out so only the pandas work is measured.
+
+    python benchmarks/bench_analysis.py --rows 1000000
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dmarc_analysis.analyzer import DMARCAnalyzer, readable_timestamps  # noqa: E402
+from dmarc_analysis.parser import RECORD_FIELDS  # noqa: E402
+
+
+class StubAnalyzer(DMARCAnalyzer):
+    def _query_blacklist(self, blacklist, ip):
+        return ip.endswith('.7'), "stub", 3600
+
+    def _query_dkim_key(self, name):
+        return ("Revoked key" if name.startswith('s3.') else ''), 3600
+
+    @staticmethod
+    def get_spf_failure_reason(ip, envelope_from):
+        return f"fail: {ip} not allowed by {envelope_from}"
+
+
+def synthetic_failures(rows, ips, seed=42):
+    """
+    Build a df_failed-like frame with the given number of rows and distinct source IPs.
+    """
+    rng = np.random.default_rng(seed)
+    begins = 1700000000 + 86400 * rng.integers(0, 365, rows)
+    results = np.array(['pass', 'fail'])
+    spf_result = results[rng.integers(0, 2, rows)]
+    dkim_result = np.where(spf_result == 'pass', 'fail', results[rng.integers(0, 2, rows)])
+    domains = np.array([f"example{i}.com" for i in range(50)])
+    header_from = domains[rng.integers(0, len(domains), rows)]
+    envelope_from = domains[rng.integers(0, len(domains), rows)]
+    return pd.DataFrame({
+        'source_ip': [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in rng.integers(0, ips, rows)],
+        'count': rng.integers(1, 100, rows),
+        'spf_result': spf_result,
+        'dkim_result': dkim_result,
+        'header_from': header_from,
+        'envelope_from': envelope_from,
+        'report_begin': begins.astype(str),
+        'report_end': (begins + 86399).astype(str),
+        'org_name': np.array(['google.com', 'Yahoo', 'Outlook.com'])[rng.integers(0, 3, rows)],
+        'dkim_domain': header_from,
+        'dkim_selector': np.array(['s0', 's1', 's2', 's3'])[rng.integers(0, 4, rows)],
+        'dkim_auth_result': dkim_result,
+        'spf_domain': envelope_from,
+        'spf_scope': 'mfrom',
+        'spf_auth_result': spf_result,
+    }, columns=list(RECORD_FIELDS))
+
+
+def legacy_stage(analyzer, df_failed):
+    """
+    The analysis stage as it used to be written: iterrows, .at writes, apply and lambdas.
+    """
+    df_failed['blacklisted'] = False
+    df_failed['spf_failure_reason'] = ''
+    df_failed['dkim_failure_reason'] = ''
+    for index, row in df_failed.iterrows():
+        if row['spf_result'] == 'fail':
+            df_failed.at[index, 'spf_failure_reason'] = analyzer.get_spf_failure_reason(
+                row['source_ip'], row['envelope_from'])
+        if row['dkim_result'] == 'fail':
+            df_failed.at[index, 'dkim_failure_reason'] = "Failed DKIM check (details not implemented)"
+        if analyzer.check_blacklist(row['source_ip'])[0]:
+            df_failed.at[index, 'blacklisted'] = True
+    df_failed['spf_alignment'] = df_failed.apply(
+        lambda x: analyzer.check_spf_alignment(x['header_from'], x['envelope_from']), axis=1)
+    for column in ('report_begin', 'report_end'):
+        df_failed[column + '_readable'] = df_failed[column].apply(
+            lambda x: datetime.fromtimestamp(int(x)).strftime("%Y-%m-%d %H:%M:%S") if pd.notnull(
+                x) and x.isdigit() else "N/A")
+    return df_failed.groupby(['report_begin', 'report_end'], as_index=False).agg({
+        'count': 'sum',
+        'spf_result': lambda x: ','.join(x.unique()),
+        'dkim_result': lambda x: ','.join(x.unique()),
+        'blacklisted': 'max',
+    })
+
+
+def vectorized_stage(analyzer, df_failed):
+    df_failed = analyzer.enrich_failures(df_failed)
+    df_failed['report_begin_readable'] = readable_timestamps(df_failed['report_begin'])
+    df_failed['report_end_readable'] = readable_timestamps(df_failed['report_end'])
+    return analyzer.aggregate_failures(df_failed)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000, help="rows in the synthetic frame")
+    parser.add_argument('--ips', type=int, default=20000, help="distinct source IPs")
+    parser.add_argument('--skip-legacy', action='store_true', help="only time the vectorized stage")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    df_failed = synthetic_failures(args.rows, args.ips)
+    analyzer = StubAnalyzer('.', 'dnsbl.invalid')
+    # Warm the blacklist cache so both variants only pay for the table work
+    analyzer.check_blacklists(df_failed['source_ip'].unique())
+
+    vectorized = timed(vectorized_stage, analyzer, df_failed.copy())
+    print(f"vectorized: {args.rows} rows in {vectorized:.2f}s ({args.rows / vectorized:,.0f} rows/s)")
+    if not args.skip_legacy:
+        legacy = timed(legacy_stage, analyzer, df_failed.copy())
+        print(f"legacy:     {args.rows} rows in {legacy:.2f}s ({args.rows / legacy:,.0f} rows/s)")
+        print(f"speedup:    {legacy / vectorized:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
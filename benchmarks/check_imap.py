@@ -0,0 +1,164 @@
+"""
+Check the hand written IMAP response parsing and the incremental download against the stub IMAP
+server, without a whole benchmark run around it:
+
+    python benchmarks/check_imap.py
+
+Every check prints OK or what went wrong; the script exits with status 1 when one of them fails.
+"""
+import gzip
+import imaplib
+import os
+import sys
+import tempfile
+import traceback
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(BENCHMARKS_DIR), BENCHMARKS_DIR]
+
+from dmarc_analysis.downloader import EmailDownloader, FetchRefused  # noqa: E402
+from dmarc_analysis.imap_parse import decode_part, parse_body_parts, parse_bodystructures  # noqa: E402
+from imap_stub import StubIMAPServer  # noqa: E402
+
+# Filenames that are awkward to get through a BODYSTRUCTURE: spaces, quotes, a backslash, RFC 2047
+FILENAMES = ['google.com!example.com!1704067200!1704153599.xml.gz', 'report with spaces.xml.gz',
+             'quoted "name".xml.gz', 'back\\slash.xml.gz', '=?utf-8?q?r=C3=A9sum=C3=A9.xml.gz?=']
+
+
+def _payload(i):
+    # mtime=0, or the same report compresses differently a second later
+    return gzip.compress(f'<feedback><report_metadata><report_id>{i}</report_id></report_metadata></feedback>'.encode(),
+                         mtime=0)
+
+
+def _mailbox(server):
+    """
+    Fill server with one message per filename and layout, enough for every UID to land on each of the
+    stub's quirks: literal filenames (UID divisible by 3) and the UID after the body part (odd UID).
+    """
+    expected = {}
+    for layout in ('single', 'multipart', 'nested'):
+        for filename in FILENAMES * 2:
+            payload = _payload(len(expected))
+            uid = server.add_message(filename, payload, multipart=layout != 'single', nested=layout == 'nested')
+            expected[uid] = (layout, filename, payload)
+    return expected
+
+
+def _connect(server):
+    mail = server.imap_class()('imap.invalid')
+    mail.login('reports@example.com', 'password')
+    mail.select('inbox', readonly=True)
+    return mail
+
+
+def check_bodystructures(server, expected):
+    mail = _connect(server)
+    try:
+        result, data = mail.uid('FETCH', '1:*', '(UID BODYSTRUCTURE)')
+    finally:
+        mail.logout()
+    assert result == 'OK', result
+    parsed = parse_bodystructures(data)
+    assert set(parsed) == set(expected), f"UIDs {sorted(set(expected) ^ set(parsed))} missing or extra"
+    for uid, (layout, filename, _) in expected.items():
+        attachment = {'single': '1', 'multipart': '2', 'nested': '2.2'}[layout]
+        texts = {'single': [], 'multipart': ['1'], 'nested': ['1', '2.1']}[layout]
+        decoded = 'résumé.xml.gz' if filename.startswith('=?') else filename
+        assert parsed[uid] == [(part, 'text/plain', None, '7bit') for part in texts] + \
+            [(attachment, 'application/gzip', decoded, 'base64')], f"UID {uid} ({layout}): {parsed[uid]}"
+    covered = {(layout, uid % 3 == 0, uid % 2 == 1) for uid, (layout, _, _) in expected.items()}
+    assert len(covered) == 12, f"Only {len(covered)} of the 12 layout/literal/UID position combinations seen"
+
+
+def check_body_parts(server, expected):
+    mail = _connect(server)
+    try:
+        for layout, part in (('single', '1'), ('multipart', '2'), ('nested', '2.2')):
+            uids = [uid for uid, (uid_layout, _, _) in expected.items() if uid_layout == layout]
+            # Text part and attachment in one FETCH, like several attachments per message would be
+            items = f'BODY.PEEK[1] BODY.PEEK[{part}]' if part != '1' else 'BODY.PEEK[1]'
+            result, data = mail.uid('FETCH', ','.join(map(str, uids)), f'(UID {items})')
+            assert result == 'OK', result
+            bodies = parse_body_parts(data)
+            assert set(bodies) == set(uids), f"{layout}: UIDs {sorted(set(uids) ^ set(bodies))} missing or extra"
+            for uid in uids:
+                assert decode_part(bodies[uid][part], 'base64') == expected[uid][2], f"UID {uid} ({layout}) payload"
+                if part != '1':
+                    assert bodies[uid]['1'] == b'DMARC report', f"UID {uid} ({layout}) text part"
+    finally:
+        mail.logout()
+
+
+def check_fetch_batch(server, expected):
+    downloader = EmailDownloader('imap.invalid', 'reports@example.com', 'password')
+    mail = _connect(server)
+    try:
+        attachments = downloader.fetch_batch(mail, sorted(expected))
+        server.fail_uids.add(min(expected))
+        try:
+            downloader.fetch_batch(mail, sorted(expected))
+        except FetchRefused:
+            pass
+        else:
+            raise AssertionError("A NO from the server did not raise FetchRefused")
+        finally:
+            server.fail_uids.clear()
+    finally:
+        mail.logout()
+    assert sorted(payload for _, payload in attachments) == sorted(payload for _, _, payload in expected.values())
+
+
+def check_incremental(server, expected):
+    imaplib.IMAP4_SSL = server.imap_class()
+    with tempfile.TemporaryDirectory() as tmp:
+        downloader = EmailDownloader('imap.invalid', 'reports@example.com', 'password',
+                                     state_path=os.path.join(tmp, 'state.json'), connections=2, batch_size=4)
+        uids = sorted(expected)
+        refused, broken = uids[3], uids[7]
+        server.fail_uids.add(refused)
+        server.broken_uids.add(broken)
+        received = []
+        downloader.fetch_new_attachments(lambda filename, payload: received.append(payload))
+        assert sorted(received) == sorted(payload for uid, (_, _, payload) in expected.items()
+                                          if uid not in (refused, broken)), "First run"
+        assert downloader.load_state()[1:] == (uids[-1], {refused: 1}), downloader.load_state()
+
+        # Still refused: asked for again, counted, nothing else fetched
+        server.fetched.clear()
+        received.clear()
+        downloader.fetch_new_attachments(lambda filename, payload: received.append(payload))
+        assert not received and downloader.load_state()[2] == {refused: 2}, downloader.load_state()
+
+        # Back in service, picked up with the new message only; the broken one stays skipped
+        server.fail_uids.clear()
+        new_uid = server.add_message('late.xml.gz', _payload(-1))
+        received.clear()
+        downloader.fetch_new_attachments(lambda filename, payload: received.append(payload))
+        assert server.fetched == {refused, new_uid}, f"Fetched {sorted(server.fetched)}"
+        assert sorted(received) == sorted([expected[refused][2], _payload(-1)]), "Retry run"
+        assert downloader.load_state()[1:] == (new_uid, {}), downloader.load_state()
+
+
+CHECKS = (check_bodystructures, check_body_parts, check_fetch_batch, check_incremental)
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        # A fresh mailbox every time, checks must not depend on each other
+        with StubIMAPServer() as server:
+            expected = _mailbox(server)
+            try:
+                check(server, expected)
+            except Exception:
+                failed += 1
+                print(f"{check.__name__:<22} FAILED")
+                traceback.print_exc()
+            else:
+                print(f"{check.__name__:<22} OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Check the rbldnsd zone file parser and the interval flattening behind local DNSBL lookups:
+
+    python benchmarks/check_zone.py
+
+Every check prints OK or what went wrong; the script exits with status 1 when one of them fails.
+"""
+import ipaddress
+import os
+import random
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dmarc_analysis.blacklist import ZoneIndex, _disjoint  # noqa: E402
+
+ZONE = """\
+# Comments, directives and blank lines are skipped
+$SOA 3600 ns.example. hostmaster.example. 1 3600 600 86400 300
+$TTL 300
+
+10.0.0.0/8
+!10.1.0.0/16
+10.1.2.0/24 :127.0.0.3:Inner listing
+10.2
+172.16.0.5-172.16.0.9
+172.16.1.5-20
+192.0.2.7:127.0.0.4:Tab and colon form
+:127.0.0.10:Default from here on
+198.51.100.0/24
+!198.51.100.128/25
+2001:db8::/32
+!2001:db8:1::/48
+2001:db8:1:2::/64 :127.0.0.5:IPv6 inner
+not-an-address
+300.1.2.3
+"""
+
+# address: expected (answer, text), None when not listed
+LOOKUPS = {
+    '10.9.9.9': ('127.0.0.2', None),
+    '10.1.9.9': None,
+    '10.1.2.3': ('127.0.0.3', 'Inner listing'),
+    '10.2.255.255': ('127.0.0.2', None),
+    '10.3.0.1': ('127.0.0.2', None),
+    '11.0.0.0': None,
+    '172.16.0.4': None,
+    '172.16.0.5': ('127.0.0.2', None),
+    '172.16.0.9': ('127.0.0.2', None),
+    '172.16.0.10': None,
+    '172.16.1.20': ('127.0.0.2', None),
+    '172.16.1.21': None,
+    '192.0.2.7': ('127.0.0.4', 'Tab and colon form'),
+    '198.51.100.1': ('127.0.0.10', 'Default from here on'),
+    '198.51.100.200': None,
+    '2001:db8::1': ('127.0.0.10', 'Default from here on'),
+    '2001:db8:1::1': None,
+    '2001:db8:1:2::1': ('127.0.0.5', 'IPv6 inner'),
+    '2001:db9::1': None,
+}
+
+
+def _reference(entries, point):
+    """
+    The brute force answer for point: the smallest entry containing it wins, an exclusion on a tie.
+    """
+    containing = [(last - first, value is not None, value) for first, last, value in entries if first <= point <= last]
+    return min(containing, key=lambda item: item[:2])[2] if containing else None
+
+
+def _lookup(segments, point):
+    return next((value for first, last, value in segments if first <= point <= last), None)
+
+
+def check_disjoint_examples():
+    # Nested, a hole punched into a listing, and a range sticking out of its container
+    segments = _disjoint([(0, 99, 'outer'), (10, 19, 'inner'), (40, 49, None), (90, 120, 'overlap')])
+    expected = ['outer'] * 10 + ['inner'] * 10 + ['outer'] * 20 + [None] * 10 + ['outer'] * 40 + \
+        ['overlap'] * 31 + [None] * 9
+    assert [_lookup(segments, point) for point in range(130)] == expected, segments
+    assert _disjoint([(5, 5, None)]) == [], "A lone exclusion lists nothing"
+    assert _disjoint([]) == []
+
+
+def check_disjoint_random():
+    rng = random.Random(1)
+    for _ in range(5000):
+        entries = []
+        for i in range(rng.randint(1, 8)):
+            size = 1 << rng.randint(0, 6)
+            first = rng.randrange(0, 64, size)
+            entries.append((first, first + size - 1, None if rng.random() < 0.3 else f"v{i}"))
+        segments = _disjoint(entries)
+        assert all(a[1] < b[0] for a, b in zip(segments, segments[1:])), f"Overlapping segments for {entries}"
+        for point in range(64):
+            expected, got = _reference(entries, point), _lookup(segments, point)
+            # On an exact tie of two listings either may win, only the exclusion has to
+            sizes = {(first, last, value): last - first for first, last, value in entries if first <= point <= last}
+            tied = {entry[2] for entry, size in sizes.items() if size == min(sizes.values(), default=None)}
+            assert got == expected or (None not in tied and got in tied), \
+                f"{point} answers {got}, expected {expected}: {entries}"
+
+
+def check_zone_file():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'zone.txt')
+        with open(path, 'w') as f:
+            f.write(ZONE)
+        index = ZoneIndex(path)
+        index.refresh()
+        for address, expected in LOOKUPS.items():
+            got = index.lookup(ipaddress.ip_address(address))
+            assert got == expected, f"{address} answers {got}, expected {expected}"
+
+
+def check_refresh():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'zone.txt')
+        with open(path, 'w') as f:
+            f.write('192.0.2.1\n')
+        index = ZoneIndex(path)
+        index.refresh()
+        address = ipaddress.ip_address('192.0.2.2')
+        assert index.lookup(address) is None
+        with open(path, 'w') as f:
+            f.write('192.0.2.0/24\n')
+        # A new mtime is what triggers the reload, like after an rsync
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        index.refresh()
+        assert index.lookup(address) == ('127.0.0.2', None), "Not reloaded after the file changed"
+        os.remove(path)
+        try:
+            index.refresh()
+        except OSError:
+            pass
+        else:
+            raise AssertionError("A missing zone file did not raise OSError")
+        assert index.lookup(address) == ('127.0.0.2', None), "The copy loaded earlier is gone"
+
+
+CHECKS = (check_disjoint_examples, check_disjoint_random, check_zone_file, check_refresh)
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception:
+            failed += 1
+            print(f"{check.__name__:<24} FAILED")
+            traceback.print_exc()
+        else:
+            print(f"{check.__name__:<24} OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+A tiny local DNS server that plays back DNSBL and SPF answers with a configurable delay,
+so the DNS stages can be benchmarked without hammering real servers.
+
+Every name under the DNSBL zone is listed (127.0.0.2) for one IP in listed_every, otherwise
+NXDOMAIN. DKIM selectors (<selector>._domainkey.<domain>) mostly publish a 2048 bit key, but one
+in ten has none, one in ten a revoked key and one in ten a 512 bit key. Every other domain gets
+an SPF record that includes _spf.<domain>, which in turn allows 10.0.0.0/16.
+"""
+import base64
+import random
+import socketserver
+import threading
+import time
+import zlib
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+
+
+def _der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    size = (length.bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + length.to_bytes(size, 'big') + content
+
+
+def dkim_key_record(bits, seed):
+    """
+    A DKIM TXT record with an RSA public key of the given size. The modulus is random, no
+    signature will ever verify with it, but it looks and measures like the real thing.
+    """
+    modulus = (random.Random(seed).getrandbits(bits) | (1 << (bits - 1))).to_bytes(bits // 8, 'big')
+    rsa_key = _der(0x30, _der(0x02, b'\0' + modulus) + _der(0x02, b'\x01\x00\x01'))
+    algorithm = _der(0x30, _der(0x06, bytes.fromhex('2a864886f70d010101')) + _der(0x05, b''))
+    key = base64.b64encode(_der(0x30, algorithm + _der(0x03, b'\0' + rsa_key))).decode()
+    # TXT strings are at most 255 characters, longer keys are split like real zones do
+    return 'v=DKIM1; k=rsa; p=' + key
+
+
+def _txt(record):
+    return ' '.join(f'"{record[i:i + 255]}"' for i in range(0, len(record), 255))
+
+
+class StubDNSServer:
+    def __init__(self, dnsbl_zone='dnsbl.invalid', latency=0.0, listed_every=20, ttl=300):
+        self.dnsbl_zone = dnsbl_zone.rstrip('.').lower()
+        self.latency = latency
+        self.listed_every = listed_every
+        self.ttl = ttl
+        self.queries = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def answer(self, query):
+        """
+        Build the response to a parsed query message.
+        """
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        name = question.name.to_text().rstrip('.').lower()
+        if name.endswith('.' + self.dnsbl_zone):
+            if question.rdtype == dns.rdatatype.A and zlib.crc32(name.encode()) % self.listed_every == 0:
+                response.answer.append(dns.rrset.from_text(question.name, self.ttl, 'IN', 'A', '127.0.0.2'))
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+        elif question.rdtype == dns.rdatatype.TXT and '._domainkey.' in name:
+            kind = zlib.crc32(name.encode()) % 10
+            if kind == 0:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            else:
+                record = 'v=DKIM1; k=rsa; p=' if kind == 1 else dkim_key_record(512 if kind == 2 else 2048, name)
+                response.answer.append(dns.rrset.from_text(question.name, self.ttl, 'IN', 'TXT', _txt(record)))
+        elif question.rdtype == dns.rdatatype.TXT:
+            if name.startswith('_spf.'):
+                record = '"v=spf1 ip4:10.0.0.0/16 ~all"'
+            else:
+                record = f'"v=spf1 include:_spf.{name} -all"'
+            response.answer.append(dns.rrset.from_text(question.name, self.ttl, 'IN', 'TXT', record))
+        return response
+
+    def start(self):
+        stub = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                with stub._lock:
+                    stub.queries += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                sock.sendto(stub.answer(dns.message.from_wire(data)).to_wire(), self.client_address)
+
+        self._server = socketserver.ThreadingUDPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def resolver(self):
+        """
+        A dnspython resolver that talks to this server only.
+        """
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = ['127.0.0.1']
+        resolver.port = self.port
+        resolver.lifetime = 5
+        return resolver
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,109 @@
+"""
+Write synthetic DMARC aggregate reports for benchmarking.
+
+    python benchmarks/generate_reports.py /tmp/reports --files 200 --records 5000 --ips 20000
+"""
+import argparse
+import gzip
+import os
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+ORGS = ['google.com', 'Yahoo', 'Outlook.com', 'Mail.Ru', 'comcast.net']
+RESULTS = ['pass', 'pass', 'pass', 'fail']
+
+
+def synthetic_ip(index, ipv6_ratio=0.1):
+    """
+    Map an index to a stable source IP; a share of them are IPv6 like in real traffic.
+    """
+    if (index * 2654435761) % 1000 < ipv6_ratio * 1000:
+        return f"2001:db8:{index // 65536 % 65536:x}:{index % 65536:x}::1"
+    return f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+
+
+def report_xml(rng, report_index, records, ips, domains, begin):
+    """
+    Build one aggregate report as bytes.
+    """
+    org = ORGS[report_index % len(ORGS)]
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n<feedback>\n'
+        '<report_metadata>'
+        f'<org_name>{escape(org)}</org_name><email>noreply-dmarc@{escape(org.lower())}</email>'
+        f'<report_id>{report_index}-{rng.getrandbits(48):x}</report_id>'
+        f'<date_range><begin>{begin}</begin><end>{begin + 86399}</end></date_range>'
+        '</report_metadata>\n'
+        f'<policy_published><domain>{domains[0]}</domain><adkim>r</adkim><aspf>r</aspf>'
+        '<p>none</p><sp>none</sp><pct>100</pct></policy_published>\n'
+    ]
+    for _ in range(records):
+        ip = synthetic_ip(rng.randrange(ips))
+        header_from = rng.choice(domains)
+        envelope_from = header_from if rng.random() < 0.8 else rng.choice(domains)
+        spf = rng.choice(RESULTS)
+        dkim = rng.choice(RESULTS)
+        selector = f"s{rng.randrange(4)}"
+        parts.append(
+            '<record><row>'
+            f'<source_ip>{ip}</source_ip><count>{rng.randint(1, 50)}</count>'
+            f'<policy_evaluated><disposition>none</disposition><dkim>{dkim}</dkim><spf>{spf}</spf>'
+            '</policy_evaluated></row>'
+            f'<identifiers><header_from>{header_from}</header_from>'
+            f'<envelope_from>{envelope_from}</envelope_from></identifiers>'
+            f'<auth_results><dkim><domain>{header_from}</domain><selector>{selector}</selector>'
+            f'<result>{dkim}</result></dkim>'
+            f'<spf><domain>{envelope_from}</domain><scope>mfrom</scope><result>{spf}</result></spf>'
+            '</auth_results></record>\n'
+        )
+    parts.append('</feedback>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def write_reports(out_dir, files=100, records=1000, ips=10000, domains=20, formats=('xml', 'gz', 'zip'), seed=1):
+    """
+    Write files reports of records records each into out_dir, cycling through formats.
+    Returns the list of paths written. The same arguments always produce the same reports.
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    domain_names = [f"example{i}.com" for i in range(domains)]
+    paths = []
+    for index in range(files):
+        content = report_xml(rng, index, records, ips, domain_names, 1700000000 + 86400 * (index % 365))
+        file_format = formats[index % len(formats)]
+        name = f"report-{index:06d}"
+        if file_format == 'xml':
+            path = os.path.join(out_dir, f"{name}.xml")
+            with open(path, 'wb') as f:
+                f.write(content)
+        elif file_format == 'gz':
+            path = os.path.join(out_dir, f"{name}.xml.gz")
+            with gzip.open(path, 'wb') as f:
+                f.write(content)
+        else:
+            path = os.path.join(out_dir, f"{name}.zip")
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                zip_ref.writestr(f"{name}.xml", content)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir')
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--records', type=int, default=1000, help="records per report")
+    parser.add_argument('--ips', type=int, default=10000, help="distinct source IPs")
+    parser.add_argument('--domains', type=int, default=20, help="distinct header/envelope domains")
+    parser.add_argument('--formats', default='xml,gz,zip', help="comma separated, cycled through")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    paths = write_reports(args.out_dir, args.files, args.records, args.ips, args.domains,
+                          tuple(args.formats.split(',')), args.seed)
+    print(f"Wrote {len(paths)} reports to {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+A tiny local stand-in for the Gmail REST API, just the calls the downloader makes: profile,
+messages.list, messages.get, messages.attachments.get and history.list. Answers come with a
+configurable delay, and one request in throttle_every is turned away the way Gmail does it when
+you go too fast (alternately a 429 and a 403 rateLimitExceeded), so the retries get exercised too.
+
+Messages carry a text part and one report attachment. Small attachments come inline with the
+message, bigger ones have to be fetched separately, like on the real thing.
+"""
+import base64
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Gmail inlines attachment data up to some size, the rest gets an attachmentId
+INLINE_LIMIT = 4096
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+class StubGmailServer:
+    def __init__(self, latency=0.0, throttle_every=25, history_window=1000):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        # How far back history.list goes before answering 404, in history ids
+        self.history_window = history_window
+        self.history_id = 1000
+        self.messages = {}
+        self.requests = 0
+        self.throttled = 0
+        self.fetched = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def add_message(self, filename, payload, content_type='application/gzip', received=None):
+        """
+        Deliver a message with one report attachment, return its id.
+        """
+        with self._lock:
+            self.history_id += 1
+            message_id = f"{self.history_id:016x}"
+            self.messages[message_id] = {'history_id': self.history_id, 'received': received or time.time(),
+                                         'filename': filename, 'content_type': content_type, 'payload': payload}
+        return message_id
+
+    def _message(self, message_id):
+        message = self.messages[message_id]
+        body = {'size': len(message['payload'])}
+        if len(message['payload']) <= INLINE_LIMIT:
+            body['data'] = _encode(message['payload'])
+        else:
+            body['attachmentId'] = f"att-{message_id}"
+        return {'id': message_id, 'historyId': str(message['history_id']), 'payload': {
+            'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'body': {'size': 0}, 'parts': [
+                {'partId': '0', 'mimeType': 'text/plain', 'filename': '',
+                 'body': {'size': 11, 'data': _encode(b'DMARC report')}},
+                {'partId': '1', 'mimeType': message['content_type'], 'filename': message['filename'], 'body': body},
+            ]}}
+
+    def _list(self, params):
+        after = re.search(r'after:(\d+)', params.get('q', ''))
+        ids = [message_id for message_id, message in self.messages.items()
+               if not after or message['received'] > int(after.group(1))]
+        ids.reverse()
+        start = int(params.get('pageToken', 0))
+        size = int(params.get('maxResults', 100))
+        page = {'messages': [{'id': message_id, 'threadId': message_id} for message_id in ids[start:start + size]],
+                'resultSizeEstimate': len(ids)}
+        if start + size < len(ids):
+            page['nextPageToken'] = str(start + size)
+        return page
+
+    def _history(self, params):
+        start_id = int(params['startHistoryId'])
+        if start_id < self.history_id - self.history_window:
+            return None
+        added = [{'id': str(message['history_id']), 'messagesAdded': [{'message': {'id': message_id}}]}
+                 for message_id, message in self.messages.items() if message['history_id'] > start_id]
+        start = int(params.get('pageToken', 0))
+        size = int(params.get('maxResults', 100))
+        page = {'history': added[start:start + size], 'historyId': str(self.history_id)}
+        if start + size < len(added):
+            page['nextPageToken'] = str(start + size)
+        return page
+
+    def answer(self, path, params):
+        """
+        Return (status, headers, body) for a GET on path.
+        """
+        with self._lock:
+            self.requests += 1
+            if self.throttle_every and self.requests % self.throttle_every == 0:
+                self.throttled += 1
+                if self.throttled % 2:
+                    return 429, {'Retry-After': '0'}, {'error': {'code': 429, 'message': 'Too many requests',
+                                                                 'status': 'RESOURCE_EXHAUSTED'}}
+                return 403, {}, {'error': {'code': 403, 'message': 'Rate limit exceeded',
+                                           'errors': [{'reason': 'rateLimitExceeded'}]}}
+            parts = path.strip('/').split('/')[4:]
+            if parts == ['profile']:
+                return 200, {}, {'emailAddress': 'reports@example.com', 'historyId': str(self.history_id),
+                                 'messagesTotal': len(self.messages)}
+            if parts == ['messages']:
+                return 200, {}, self._list(params)
+            if parts == ['history']:
+                page = self._history(params)
+                if page is None:
+                    return 404, {}, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+                return 200, {}, page
+            if len(parts) == 2 and parts[0] == 'messages' and parts[1] in self.messages:
+                self.fetched.add(parts[1])
+                return 200, {}, self._message(parts[1])
+            if len(parts) == 4 and parts[2] == 'attachments' and parts[1] in self.messages:
+                payload = self.messages[parts[1]]['payload']
+                return 200, {}, {'size': len(payload), 'data': _encode(payload)}
+            return 404, {}, {'error': {'code': 404, 'message': 'Not Found'}}
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                url = urlparse(self.path)
+                params = {name: values[0] for name, values in parse_qs(url.query).items()}
+                status, headers, body = stub.answer(url.path, params)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
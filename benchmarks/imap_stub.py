@@ -0,0 +1,217 @@
+"""
+A tiny local IMAP server that speaks just enough IMAP4rev1 for the downloader: CAPABILITY, LOGIN,
+EXAMINE/SELECT, UID SEARCH, UID FETCH of BODYSTRUCTURE and BODY.PEEK[n], LOGOUT. Over plain TCP,
+imaplib.IMAP4_SSL can be pointed at it with imap_class().
+
+Answers are shaped like real servers shape them, so the hand written response parsing gets a workout:
+report messages are either multipart (a text part, then the attachment as part 2), nested (a text part,
+then a multipart with another text part and the attachment as part 2.2, like a forwarded report) or the
+attachment alone (part 1), every third filename is sent as a {n} literal inside the BODYSTRUCTURE, and every other
+message has its UID after the body part instead of before it. UIDs in fail_uids make any FETCH that
+includes them answer NO, like a server that is briefly unavailable; the attachments of UIDs in
+broken_uids come back as base64 that does not decode.
+"""
+import base64
+import imaplib
+import re
+import socketserver
+import threading
+import time
+
+UID_SET_ITEM = re.compile(r'(\d+)(?::(\d+|\*))?')
+BODY_PEEK = re.compile(r'BODY\.PEEK\[([\d.]+)\]', re.IGNORECASE)
+SEARCH_FROM = re.compile(r'UID (\d+):\*', re.IGNORECASE)
+SUBJECT = re.compile(r'HEADER Subject "([^"]*)"', re.IGNORECASE)
+
+
+def _quoted(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class StubIMAPServer:
+    def __init__(self, latency=0.0, uidvalidity=1, fail_uids=(), broken_uids=()):
+        self.latency = latency
+        self.uidvalidity = uidvalidity
+        self.fail_uids = set(fail_uids)
+        self.broken_uids = set(broken_uids)
+        self.messages = []
+        self.next_uid = 1
+        self.commands = 0
+        self.fetched = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def add_message(self, filename, payload, content_type='application/gzip', subject='Report domain: example.com',
+                    multipart=None, nested=False):
+        """
+        Deliver a message with one report attachment, return its UID. UIDs leave gaps now and then,
+        like they do after messages are moved out of a real mailbox.
+        """
+        with self._lock:
+            uid = self.next_uid
+            self.next_uid += 1 + (uid % 7 == 0)
+            self.messages.append({'uid': uid, 'filename': filename, 'content_type': content_type,
+                                  'subject': subject, 'payload': base64.encodebytes(payload),
+                                  'multipart': uid % 2 == 1 if multipart is None else multipart,
+                                  'nested': nested})
+        return uid
+
+    def _bodystructure(self, message):
+        """
+        The BODYSTRUCTURE of a message as a list of chunks, a literal being ('{n}', data).
+        """
+        main, sub = message['content_type'].split('/')
+        filename = message['filename']
+        name = (f'{{{len(filename.encode())}}}', filename.encode()) if message['uid'] % 3 == 0 \
+            else _quoted(filename)
+        head = f'({_quoted(main)} {_quoted(sub)} ("name" {_quoted(filename)}) NIL NIL "base64" ' \
+               f'{len(message["payload"])} NIL ("attachment" ("filename" '
+        attachment = [head, name, ')) NIL NIL)']
+        text = '("text" "plain" ("charset" "us-ascii") NIL NIL "7bit" 12 1 NIL NIL NIL NIL)'
+        if message['nested']:
+            return ['(', text, '(', text] + attachment + [' "mixed" ("boundary" "inner-boundary") NIL NIL NIL)',
+                                                          ' "mixed" ("boundary" "report-boundary") NIL NIL NIL)']
+        if not message['multipart']:
+            return attachment
+        return ['(', text] + attachment + [' "mixed" ("boundary" "report-boundary") NIL NIL NIL)']
+
+    @staticmethod
+    def attachment_part(message):
+        return '2.2' if message['nested'] else '2' if message['multipart'] else '1'
+
+    def _matching(self, uid_set):
+        highest = self.messages[-1]['uid'] if self.messages else 0
+        ranges = []
+        for item in uid_set.split(','):
+            match = UID_SET_ITEM.fullmatch(item)
+            low = int(match.group(1))
+            high = low if match.group(2) is None else highest if match.group(2) == '*' else int(match.group(2))
+            ranges.append((min(low, high), max(low, high)))
+        return [(seq, message) for seq, message in enumerate(self.messages, start=1)
+                if any(low <= message['uid'] <= high for low, high in ranges)]
+
+    def fetch(self, uid_set, items):
+        """
+        Return (status, untagged responses) for UID FETCH, each response a list of chunks as in _bodystructure.
+        """
+        matching = self._matching(uid_set)
+        if any(message['uid'] in self.fail_uids for _, message in matching):
+            return 'NO [UNAVAILABLE] Message store busy, try again later', []
+        parts = BODY_PEEK.findall(items)
+        responses = []
+        for seq, message in matching:
+            uid = f"UID {message['uid']}"
+            if 'BODYSTRUCTURE' in items.upper():
+                body = ['BODYSTRUCTURE '] + self._bodystructure(message)
+            else:
+                self.fetched.add(message['uid'])
+                body = []
+                for part in parts:
+                    # Any other part is one of the text parts
+                    data = message['payload'] if part == self.attachment_part(message) else b'DMARC report'
+                    if message['uid'] in self.broken_uids and data is message['payload']:
+                        data = b'bm90IGEgcmVwb3J0\r\nQ'
+                    body += [f'BODY[{part}] ', (f'{{{len(data)}}}', data), ' ']
+                body = body[:-1]
+            # Servers are free to order the items as they like, some put the UID last
+            if message['uid'] % 2:
+                responses.append([f'* {seq} FETCH ('] + body + [f' {uid})'])
+            else:
+                responses.append([f'* {seq} FETCH ({uid} '] + body + [')'])
+        return 'OK FETCH completed', responses
+
+    def search(self, criteria):
+        start = SEARCH_FROM.search(criteria)
+        subject = SUBJECT.search(criteria)
+        uids = [message['uid'] for message in self.messages
+                if not subject or subject.group(1).lower() in message['subject'].lower()]
+        if start:
+            # n:* matches the newest message even when its UID is below n, like on a real server
+            low = int(start.group(1))
+            uids = [uid for uid in uids if uid >= low] or uids[-1:]
+        return ' '.join(map(str, uids))
+
+    def start(self):
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def send(self, chunks):
+                data = bytearray()
+                for chunk in chunks:
+                    if isinstance(chunk, tuple):
+                        data += chunk[0].encode() + b'\r\n' + chunk[1]
+                    else:
+                        data += chunk.encode()
+                self.wfile.write(bytes(data) + b'\r\n')
+
+            def handle(self):
+                self.send(['* OK [CAPABILITY IMAP4rev1] Stub IMAP server ready'])
+                for line in self.rfile:
+                    tag, _, command = line.decode().rstrip('\r\n').partition(' ')
+                    name, _, args = command.partition(' ')
+                    with stub._lock:
+                        stub.commands += 1
+                    if stub.latency:
+                        time.sleep(stub.latency)
+                    name = name.upper()
+                    if name == 'CAPABILITY':
+                        self.send(['* CAPABILITY IMAP4rev1'])
+                    elif name in ('SELECT', 'EXAMINE'):
+                        self.send([f'* {len(stub.messages)} EXISTS'])
+                        self.send([f'* OK [UIDVALIDITY {stub.uidvalidity}] UIDs valid'])
+                        self.send([f'{tag} OK [READ-ONLY] {name} completed'])
+                        continue
+                    elif name == 'LOGOUT':
+                        self.send(['* BYE Logging out'])
+                        self.send([f'{tag} OK LOGOUT completed'])
+                        return
+                    elif name == 'UID':
+                        sub, _, rest = args.partition(' ')
+                        if sub.upper() == 'SEARCH':
+                            with stub._lock:
+                                self.send([f'* SEARCH {stub.search(rest)}'.rstrip()])
+                        else:
+                            uid_set, _, items = rest.partition(' ')
+                            with stub._lock:
+                                status, responses = stub.fetch(uid_set, items)
+                            for response in responses:
+                                self.send(response)
+                            self.send([f'{tag} {status}'])
+                            continue
+                    elif name != 'LOGIN':
+                        self.send([f'{tag} BAD Unknown command'])
+                        continue
+                    self.send([f'{tag} OK {name} completed'])
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def imap_class(self):
+        """
+        An imaplib.IMAP4 subclass that takes IMAP4_SSL's place and connects here instead.
+        """
+        port = self.port
+
+        class StubIMAP4(imaplib.IMAP4):
+            def __init__(self, host='', *args, **kwargs):
+                super().__init__('127.0.0.1', port)
+
+        return StubIMAP4
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
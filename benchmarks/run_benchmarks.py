@@ -0,0 +1,383 @@
+"""
+Benchmark the download, parse, decompression, ingestion, DNS and aggregation stages on synthetic reports.
+
+Each stage runs in a fresh process so its peak RSS is its own. Results are printed and written
+as JSON, which can be compared with an earlier run:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    ... change things ...
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [REPO_DIR, BENCHMARKS_DIR]
+
+STAGES = ('imap', 'gmail', 'parse', 'extract', 'ingest', 'dnsbl', 'dnsbl_local', 'spf', 'dkim', 'aggregation', 'write')
+
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+def parsed_records(report_dir):
+    from dmarc_analysis.ingest import find_report_files
+    from dmarc_analysis.parser import parse_report_file
+    records = []
+    for file_path in find_report_files(report_dir):
+        records.extend(parse_report_file(file_path))
+    return records
+
+
+def stage_imap(report_dir, options):
+    import imaplib
+    from dmarc_analysis.downloader import EmailDownloader
+    from imap_stub import StubIMAPServer
+    names = sorted(os.listdir(report_dir))
+    with StubIMAPServer(latency=options['imap_latency']) as server, tempfile.TemporaryDirectory() as tmp:
+        imaplib.IMAP4_SSL = server.imap_class()
+        for name in names:
+            with open(os.path.join(report_dir, name), 'rb') as f:
+                server.add_message(name, f.read())
+        # One message the server refuses for now and one that cannot be decoded,
+        # neither may hold up the others; the refused one is fetched again next run
+        refused = server.messages[len(names) // 2]['uid']
+        server.fail_uids.add(refused)
+        server.broken_uids.add(server.messages[len(names) // 3]['uid'])
+        downloader = EmailDownloader('imap.invalid', 'reports@example.com', 'password',
+                                     state_path=os.path.join(tmp, 'state.json'),
+                                     connections=options['imap_connections'], batch_size=20)
+        received = []
+        start = time.perf_counter()
+        downloader.fetch_new_attachments(lambda filename, payload: received.append(filename))
+        seconds = time.perf_counter() - start
+        if len(received) != len(names) - 2:
+            raise RuntimeError(f"Full sync downloaded {len(received)} of {len(names) - 2} reports")
+
+        server.fetched.clear()
+        server.fail_uids.clear()
+        new_uids = {server.add_message(f"late-{i}.xml", b'<feedback/>', 'application/xml') for i in range(5)}
+        received.clear()
+        downloader.fetch_new_attachments(lambda filename, payload: received.append(filename))
+        if server.fetched != new_uids | {refused} or len(received) != 6:
+            raise RuntimeError(f"Incremental sync fetched UIDs {sorted(server.fetched)}, "
+                               f"expected {sorted(new_uids | {refused})}")
+        commands = server.commands
+    return seconds, {'messages/s': len(names) / seconds, 'commands': commands}
+
+
+def stage_gmail(report_dir, options):
+    from google.auth.credentials import AnonymousCredentials
+    from dmarc_analysis.downloader import EmailDownloader
+    from gmail_stub import StubGmailServer
+    names = sorted(os.listdir(report_dir))
+    with StubGmailServer(latency=options['api_latency']) as server, tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            with open(os.path.join(report_dir, name), 'rb') as f:
+                server.add_message(name, f.read())
+        downloader = EmailDownloader(None, 'reports@example.com', state_path=os.path.join(tmp, 'state.json'),
+                                     backend='gmail_api', api_workers=options['api_workers'],
+                                     gmail_api_url=server.url)
+        downloader.credentials = AnonymousCredentials()
+        received = []
+        start = time.perf_counter()
+        downloader.fetch_new_attachments(lambda filename, payload: received.append(filename))
+        seconds = time.perf_counter() - start
+        if len(received) != len(names):
+            raise RuntimeError(f"Full sync downloaded {len(received)} of {len(names)} reports")
+
+        # The next run only picks up what arrived in between
+        server.fetched.clear()
+        for i in range(5):
+            server.add_message(f"late-{i}.xml", b'<feedback/>', 'application/xml')
+        received.clear()
+        downloader.fetch_new_attachments(lambda filename, payload: received.append(filename))
+        if len(server.fetched) != 5 or len(received) != 5:
+            raise RuntimeError(f"Incremental sync fetched {len(server.fetched)} messages, expected 5")
+        requests, throttled = server.requests, server.throttled
+    return seconds, {'messages/s': len(names) / seconds, 'requests': requests, 'throttled': throttled}
+
+
+def stage_parse(report_dir, options):
+    from dmarc_analysis.ingest import find_report_files
+    from dmarc_analysis.parser import parse_report_file
+    file_paths = find_report_files(report_dir)
+    start = time.perf_counter()
+    records = sum(len(parse_report_file(file_path)) for file_path in file_paths)
+    seconds = time.perf_counter() - start
+    return seconds, {'records/s': records / seconds, 'files/s': len(file_paths) / seconds}
+
+
+def stage_extract(report_dir, options):
+    from dmarc_analysis.analyzer import DMARCAnalyzer
+    from dmarc_analysis.ingest import find_report_files
+    analyzer = DMARCAnalyzer(report_dir, 'dnsbl.invalid')
+    file_paths = [path for path in find_report_files(report_dir) if path.endswith(('.gz', '.zip'))]
+    start = time.perf_counter()
+    extracted = 0
+    for file_path in file_paths:
+        if file_path.endswith('.gz'):
+            extracted += len(analyzer.extract_gz(file_path) or b'')
+        else:
+            extracted += sum(len(content) for content in analyzer.extract_zip(file_path))
+    seconds = time.perf_counter() - start
+    return seconds, {'files/s': len(file_paths) / seconds, 'MB/s': extracted / seconds / 1e6}
+
+
+def stage_ingest(report_dir, options):
+    from dmarc_analysis.ingest import find_report_files, ingest_reports
+    file_paths = find_report_files(report_dir)
+    start = time.perf_counter()
+    records = len(ingest_reports(file_paths, options['workers']))
+    seconds = time.perf_counter() - start
+    return seconds, {'records/s': records / seconds, 'files/s': len(file_paths) / seconds}
+
+
+def stage_dnsbl(report_dir, options):
+    from dmarc_analysis.analyzer import DMARCAnalyzer
+    from dns_stub import StubDNSServer
+    ips = {record[0] for record in parsed_records(report_dir)}
+    with StubDNSServer(latency=options['dns_latency']) as server:
+        analyzer = DMARCAnalyzer(report_dir, server.dnsbl_zone, dns_workers=options['dns_workers'])
+        analyzer.resolver = server.resolver()
+        start = time.perf_counter()
+        analyzer.check_blacklists(ips)
+        seconds = time.perf_counter() - start
+        queries = server.queries
+    return seconds, {'lookups/s': len(ips) / seconds, 'queries': queries}
+
+
+def stage_dnsbl_local(report_dir, options):
+    import ipaddress
+    import tempfile
+    from dmarc_analysis.analyzer import DMARCAnalyzer
+    from dmarc_analysis.blacklist import Blacklist
+    ips = sorted({record[0] for record in parsed_records(report_dir)})
+    with tempfile.TemporaryDirectory() as tmp:
+        # A zone about the size of a real one: every 20th sender listed, each with its network around it
+        zone_file = os.path.join(tmp, 'zone.txt')
+        with open(zone_file, 'w') as f:
+            for ip in ips[::20]:
+                prefix = 24 if ipaddress.ip_address(ip).version == 4 else 64
+                f.write(f"{ipaddress.ip_network(f'{ip}/{prefix}', strict=False)}\n!{ip}\n")
+        analyzer = DMARCAnalyzer(report_dir, 'dnsbl.invalid',
+                                 blacklists=[Blacklist('dnsbl.invalid', zone_file=zone_file)])
+        start = time.perf_counter()
+        analyzer.check_blacklists(ips)
+        seconds = time.perf_counter() - start
+    return seconds, {'lookups/s': len(ips) / seconds}
+
+
+def stage_spf(report_dir, options):
+    import dns.resolver
+    from dmarc_analysis.analyzer import DMARCAnalyzer
+    from dns_stub import StubDNSServer
+    pairs = {(record[0], record[5]) for record in parsed_records(report_dir) if record[2] == 'fail'}
+    with StubDNSServer(latency=options['dns_latency']) as server:
+        # pyspf resolves through dnspython's default resolver
+        dns.resolver.default_resolver = server.resolver()
+        analyzer = DMARCAnalyzer(report_dir, server.dnsbl_zone, spf_workers=options['spf_workers'])
+        start = time.perf_counter()
+        analyzer.get_spf_failure_reasons(pairs)
+        seconds = time.perf_counter() - start
+        queries = server.queries
+    return seconds, {'lookups/s': len(pairs) / seconds, 'queries': queries}
+
+
+def stage_dkim(report_dir, options):
+    from dmarc_analysis.analyzer import DMARCAnalyzer
+    from dns_stub import StubDNSServer
+    # dkim_domain, dkim_selector, dkim_auth_result, header_from
+    signatures = {(record[9], record[10], record[11], record[4]) for record in parsed_records(report_dir)
+                  if record[3] == 'fail'}
+    with StubDNSServer(latency=options['dns_latency']) as server:
+        analyzer = DMARCAnalyzer(report_dir, server.dnsbl_zone, dns_workers=options['dns_workers'])
+        analyzer.resolver = server.resolver()
+        start = time.perf_counter()
+        analyzer.get_dkim_failure_reasons(signatures)
+        seconds = time.perf_counter() - start
+        queries = server.queries
+    return seconds, {'signatures/s': len(signatures) / seconds, 'queries': queries}
+
+
+def stage_aggregation(report_dir, options):
+    import pandas as pd
+    from bench_analysis import StubAnalyzer, vectorized_stage
+    from dmarc_analysis.parser import RECORD_FIELDS
+    df = pd.DataFrame.from_records(parsed_records(report_dir), columns=RECORD_FIELDS)
+    df_failed = df[(df['spf_result'] == 'fail') | (df['dkim_result'] == 'fail')].copy()
+    analyzer = StubAnalyzer(report_dir, 'dnsbl.invalid')
+    start = time.perf_counter()
+    vectorized_stage(analyzer, df_failed)
+    seconds = time.perf_counter() - start
+    return seconds, {'records/s': len(df_failed) / seconds}
+
+
+def stage_write(report_dir, options):
+    import pandas as pd
+    from dmarc_analysis.output import OutputWriter
+    from dmarc_analysis.parser import RECORD_FIELDS
+    df = pd.DataFrame.from_records(parsed_records(report_dir), columns=RECORD_FIELDS)
+    chunk_rows = options['chunk_rows']
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        with OutputWriter(os.path.join(tmp, 'results'), options['write_format'], options['write_compression'],
+                          options['write_partitioned']) as writer:
+            for offset in range(0, len(df), chunk_rows):
+                writer.write(df.iloc[offset:offset + chunk_rows])
+        seconds = time.perf_counter() - start
+        paths = [os.path.join(writer.path, name) for name in os.listdir(writer.path)] \
+            if os.path.isdir(writer.path) else [writer.path]
+        size = sum(os.path.getsize(path) for path in paths)
+    return seconds, {'records/s': len(df) / seconds, 'mb_written': size / 2 ** 20}
+
+
+def run_stage(name, report_dir, options, results):
+    import dmarc_analysis.analyzer  # noqa: F401, configures logging on import
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        seconds, throughput = globals()[f"stage_{name}"](report_dir, options)
+    except Exception as e:
+        # Stages raise on purpose when a check fails, the parent must hear about it either way
+        traceback.print_exc()
+        results.put({'error': f"{type(e).__name__}: {e}"})
+        return
+    results.put({'seconds': round(seconds, 4), **{key: round(value, 2) for key, value in throughput.items()},
+                 'peak_rss_mb': round(peak_rss_mb(), 1)})
+
+
+def measure(name, report_dir, options):
+    """
+    Run one stage in a fresh process and return its measurements, or {'error': ...} when it failed.
+    """
+    # Progress bars would only get in the way of the numbers
+    os.environ['TQDM_DISABLE'] = '1'
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_stage, args=(name, report_dir, options, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                # Killed or crashed before it could report, by the OOM killer for instance
+                try:
+                    result = results.get(timeout=1)
+                except queue.Empty:
+                    result = {'error': f"stage process died with exit code {process.exitcode}"}
+                break
+    process.join()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({(baseline.get('commit') or 'unknown')[:10]}):")
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if not before or 'error' in before or 'error' in stage:
+            continue
+        change = before['seconds'] / stage['seconds'] if stage['seconds'] else float('inf')
+        print(f"  {name:<12} {before['seconds']:>9.3f}s -> {stage['seconds']:>9.3f}s  ({change:.2f}x)  "
+              f"peak RSS {before['peak_rss_mb']:.0f} -> {stage['peak_rss_mb']:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=60, help="number of reports to generate")
+    parser.add_argument('--records', type=int, default=2000, help="records per report")
+    parser.add_argument('--ips', type=int, default=5000, help="distinct source IPs")
+    parser.add_argument('--domains', type=int, default=20, help="distinct header/envelope domains")
+    parser.add_argument('--dns-latency', type=float, default=0.005, help="stub DNS answer delay in seconds")
+    parser.add_argument('--dns-workers', type=int, default=16)
+    parser.add_argument('--spf-workers', type=int, default=8)
+    parser.add_argument('--imap-latency', type=float, default=0.02, help="stub IMAP answer delay in seconds")
+    parser.add_argument('--imap-connections', type=int, default=4)
+    parser.add_argument('--api-latency', type=float, default=0.02, help="stub Gmail API answer delay in seconds")
+    parser.add_argument('--api-workers', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None, help="ingestion processes (default: one per core)")
+    parser.add_argument('--write-format', default='csv', help="output format of the write stage")
+    parser.add_argument('--write-compression', default='none', help="compression of the write stage")
+    parser.add_argument('--write-partitioned', action='store_true', help="write stage writes parallel parts")
+    parser.add_argument('--chunk-rows', type=int, default=250000, help="rows per chunk in the write stage")
+    parser.add_argument('--stages', default=','.join(STAGES), help="comma separated subset of " + ', '.join(STAGES))
+    parser.add_argument('--reports', help="use this directory of reports instead of generating them")
+    parser.add_argument('--output', default='bench_results.json', help="where to write the JSON results")
+    parser.add_argument('--compare', help="earlier JSON results to compare with")
+    args = parser.parse_args()
+    stages = args.stages.split(',')
+    unknown = [name for name in stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages {', '.join(unknown)}, pick from {', '.join(STAGES)}")
+
+    options = {'dns_latency': args.dns_latency, 'dns_workers': args.dns_workers,
+               'spf_workers': args.spf_workers, 'workers': args.workers, 'write_format': args.write_format,
+               'write_compression': args.write_compression, 'write_partitioned': args.write_partitioned,
+               'chunk_rows': args.chunk_rows, 'api_latency': args.api_latency, 'api_workers': args.api_workers,
+               'imap_latency': args.imap_latency, 'imap_connections': args.imap_connections}
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {**vars(args), **options},
+        'stages': {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix='dmarc-bench-') as tmp_dir:
+        report_dir = args.reports
+        if not report_dir:
+            from generate_reports import write_reports
+            report_dir = tmp_dir
+            print(f"Generating {args.files} reports of {args.records} records...")
+            write_reports(report_dir, args.files, args.records, args.ips, args.domains)
+
+        failed = []
+        for name in stages:
+            stage = measure(name, report_dir, options)
+            results['stages'][name] = stage
+            if 'error' in stage:
+                failed.append(name)
+                print(f"{name:<12} FAILED: {stage['error']}")
+                continue
+            rates = ', '.join(f"{value:,.0f} {key}" for key, value in stage.items() if '/' in key)
+            print(f"{name:<12} {stage['seconds']:>9.3f}s  {rates}  peak RSS {stage['peak_rss_mb']:.0f} MB")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+    if failed:
+        sys.exit(f"Failed stages: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Measure how long each entry point takes to start, in a fresh interpreter every time, and check that
+the heavy libraries stay unloaded where they are not needed: `main.py --help`, `fetch` and the
+parse workers have no business loading pandas or the Google auth stack.
+
+    python benchmarks/startup_time.py --output before.json
+    ... change things ...
+    python benchmarks/startup_time.py --output after.json --compare before.json
+
+Exits with status 1 when a module shows up where it should not, so it can run in CI as is.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'dns.resolver', 'spf', 'requests', 'google.auth',
+                 'google_auth_oauthlib')
+
+GOOGLE_AUTH = ('requests', 'google.auth', 'google_auth_oauthlib')
+
+# name: (code to run, modules it must not load)
+ENTRY_POINTS = {
+    'main --help': ("import sys; sys.argv = ['main.py', '--help']\n"
+                    "import main\n"
+                    "try:\n    main.main()\nexcept SystemExit:\n    pass",
+                    HEAVY_MODULES),
+    'main': ("import main", HEAVY_MODULES),
+    # fetch with an app password: IMAP only
+    'downloader': ("import dmarc_analysis.downloader", HEAVY_MODULES),
+    # What every ingest worker process imports before it can parse a single report
+    'ingest worker': ("import dmarc_analysis.ingest", ('pandas', 'pyarrow') + GOOGLE_AUTH),
+    'analyzer': ("import dmarc_analysis.analyzer", GOOGLE_AUTH),
+}
+
+_REPORT = "\nimport json, sys\nprint(json.dumps([m for m in {modules!r} if m in sys.modules]))"
+
+
+def measure(code, runs):
+    """
+    Run code in runs fresh interpreters, return (median seconds, heavy modules it loaded).
+    """
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code + _REPORT.format(modules=HEAVY_MODULES)],
+                                cwd=REPO_DIR, capture_output=True, text=True, check=True)
+        timings.append(time.perf_counter() - start)
+        loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return statistics.median(timings), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7, help="interpreters started per entry point")
+    parser.add_argument('--output', default='startup_results.json', help="where to write the JSON results")
+    parser.add_argument('--compare', help="earlier JSON results to compare with")
+    args = parser.parse_args()
+
+    # Warm the file cache and the .pyc files, the first start is always the slowest
+    subprocess.run([sys.executable, '-c', 'import dmarc_analysis.analyzer, main'], cwd=REPO_DIR, check=True)
+    bare, _ = measure('pass', args.runs)
+    print(f"{'python':<14} {bare * 1000:>7.0f} ms  (interpreter alone)")
+
+    results = {'python': bare, 'entry_points': {}}
+    failed = False
+    for name, (code, forbidden) in ENTRY_POINTS.items():
+        seconds, loaded = measure(code, args.runs)
+        unexpected = [module for module in loaded if module in forbidden]
+        results['entry_points'][name] = {'seconds': seconds, 'loaded': loaded}
+        note = f"  loads {', '.join(unexpected)}, it should not!" if unexpected else ""
+        print(f"{name:<14} {seconds * 1000:>7.0f} ms  (+{(seconds - bare) * 1000:.0f} ms imports){note}")
+        failed = failed or bool(unexpected)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare}:")
+        for name, entry in results['entry_points'].items():
+            before = baseline.get('entry_points', {}).get(name)
+            if before:
+                print(f"  {name:<14} {before['seconds'] * 1000:>7.0f} ms -> {entry['seconds'] * 1000:>7.0f} ms")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
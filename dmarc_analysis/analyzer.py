@@ -1,4 +1,3 @@
-from datetime import datetime
 import platform
 import subprocess
 import xml.etree.ElementTree as ET
@@ -10,69 +9,111 @@ import gzip
 import zipfile
 from tqdm import tqdm
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+import hashlib
 from io import BytesIO
+from dateutil.tz import tzlocal
+from dmarc_analysis.blacklist import Blacklist, parse_ip
+from dmarc_analysis.cache import TTLCache
+from dmarc_analysis.dkim import failure_reason, fetch_key_problem, key_name
+from dmarc_analysis.parser import RECORD_FIELDS, iter_report_records
+from dmarc_analysis.ingest import find_report_files, ingest_reports, iter_parsed_files
+from dmarc_analysis.records import RecordBatch, read_report_batch
+from dmarc_analysis.manifest import STREAM_PREFIX, ReportManifest, file_digest
+from dmarc_analysis.metrics import RunMetrics
+from dmarc_analysis.output import OutputWriter, check_output
+from dmarc_analysis.store import RecordStore, failed_filter
+from dmarc_analysis.spf_lookup import CachingSPFLookup
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def readable_timestamps(values):
+    """
+    Turn a Series of epoch-second strings into local 'YYYY-MM-DD HH:MM:SS' text, "N/A" when a
+    value is not a timestamp. Each distinct value is formatted once, reports share a handful
+    of date ranges across millions of rows.
+    """
+    uniques = values.drop_duplicates()
+    seconds = pd.to_numeric(uniques.where(uniques.astype(str).str.isdigit()), errors='coerce')
+    formatted = pd.to_datetime(seconds, unit='s', utc=True).dt.tz_convert(tzlocal()).dt.strftime(TIMESTAMP_FORMAT)
+    return values.map(pd.Series(formatted.fillna("N/A").values, index=uniques.values)).astype(str)
+
+
+def email_domains(values):
+    return values.astype(str).str.rsplit('@', n=1).str[-1]
+
+
+# What a DKIM failure is explained from
+DKIM_SIGNATURE = ('dkim_domain', 'dkim_selector', 'dkim_auth_result', 'header_from')
+
 
 class DMARCAnalyzer:
-    def __init__(self, directory, spamhaus_domain):
+    def __init__(self, directory, spamhaus_domain, dns_workers=16, blacklist_cache_path=None, negative_ttl=3600,
+                 spf_workers=8, ingest_workers=None, ingest_chunk_size=16, manifest_path=None, store_dir=None,
+                 start_date=None, end_date=None, spf_cache_ttl=3600, hooks=None, blacklists=None,
+                 dkim_cache_path=None, output_format='csv', output_compression='none', output_chunk_rows=250000,
+                 output_partitioned=False, output_workers=None):
         self.directory = directory
         self.spamhaus_domain = spamhaus_domain
-        self.all_records = []
+        # Every list is asked about every IP, Spamhaus alone unless told otherwise
+        self.blacklists = list(blacklists or [Blacklist(spamhaus_domain)])
+        self.all_records = RecordBatch()
         self.resolver = dns.resolver.Resolver()
         self.resolver.nameservers = ['8.8.8.8', '8.8.4.4']  # Use Google DNS servers
+        self.dns_workers = max(1, dns_workers)
+        self.negative_ttl = negative_ttl
+        self.blacklist_cache = TTLCache(blacklist_cache_path)
+        self.blacklist_cache.load()
+        self.dkim_cache = TTLCache(dkim_cache_path)
+        self.dkim_cache.load()
+        self.spf_workers = max(1, spf_workers)
+        self.spf_cache_ttl = spf_cache_ttl
+        self.spf_lookup = None
+        self.spf_lookup_created = 0
+        self.ingest_workers = ingest_workers
+        self.ingest_chunk_size = max(1, ingest_chunk_size)
+        self.manifest_path = manifest_path
+        self.record_store = None
+        if manifest_path:
+            self.record_store = RecordStore(store_dir or os.path.join(os.path.dirname(manifest_path), 'records'))
+        self.start_date = start_date
+        self.end_date = end_date
+        self.streamed_paths = set()
+        check_output(output_format, output_compression)
+        self.output_format = output_format
+        self.output_compression = output_compression
+        self.output_chunk_rows = max(1, output_chunk_rows)
+        self.output_partitioned = output_partitioned
+        self.output_workers = output_workers
+        self.hooks = list(hooks or [])
+        # Replaced at the start of every analyze_reports, the last run's numbers stay readable afterwards
+        self.metrics = RunMetrics(self.hooks)
+
+    def add_hook(self, hook):
+        """
+        Register an AnalysisHook (see dmarc_analysis.metrics) for the next runs.
+        """
+        self.hooks.append(hook)
 
     @staticmethod
     def parse_dmarc_report(file_path):
         """
-        Parse DMARC report from an XML file.
+        Parse DMARC report from an XML file into a RecordBatch.
         This function tries to parse the XML like it's deciphering hieroglyphics.
         """
         try:
-            tree = ET.parse(file_path)
-            root = tree.getroot()
-            # Extract the date_range information
-            date_range_elem = root.find('.//date_range')
-            begin = date_range_elem.find('begin').text if date_range_elem is not None and date_range_elem.find(
-                'begin') is not None else None
-            end = date_range_elem.find('end').text if date_range_elem is not None and date_range_elem.find(
-                'end') is not None else None
-
-            records = []
-            for record in root.findall('.//record'):
-                row = record.find('row')
-                policy_evaluated = row.find('policy_evaluated') if row is not None else None
-                identifiers = record.find('identifiers')
-
-                if row is not None and policy_evaluated is not None:
-                    source_ip = row.find('source_ip').text if row.find('source_ip') is not None else 'unknown'
-                    count = int(row.find('count').text) if row.find('count') is not None else 0
-                    spf_result = policy_evaluated.find('spf').text if policy_evaluated.find(
-                        'spf') is not None else 'none'
-                    dkim_result = policy_evaluated.find('dkim').text if policy_evaluated.find(
-                        'dkim') is not None else 'none'
-                    header_from = identifiers.find('header_from').text if identifiers is not None and identifiers.find(
-                        'header_from') is not None else 'unknown'
-                    envelope_from = identifiers.find(
-                        'envelope_from').text if identifiers is not None and identifiers.find(
-                        'envelope_from') is not None else 'unknown'
-
-                    records.append({
-                        'source_ip': source_ip,
-                        'count': count,
-                        'spf_result': spf_result,
-                        'dkim_result': dkim_result,
-                        'header_from': header_from,
-                        'envelope_from': envelope_from,
-                        'report_begin': begin,
-                        'report_end': end
-                    })
-            return records
+            batch = RecordBatch()
+            for report, row in iter_report_records(file_path):
+                batch.append(report, row)
+            return batch
         except ET.ParseError:
             logging.error(f"Error parsing {file_path}")
-            return []
+            return RecordBatch()
 
     def extract_gz(self, file_path):
         """
@@ -103,25 +144,111 @@ class DMARCAnalyzer:
             logging.error(f"Error extracting {file_path}: {e}")
             return []
 
-    def check_blacklist(self, ip):
+    def _query_blacklist(self, blacklist, ip):
         """
-        Check if an IP is blacklisted.
-         We ask the blacklist, 'Hey, you seen this guy around here?'.
+        Run a single DNSBL query against one list and return (is_listed, detail, ttl).
+        Errors come back with a ttl of 0 so they are never cached.
         """
+        address = parse_ip(ip)
+        if address is None:
+            return False, "Not an IP address", 0
+        self.metrics.count('dnsbl_local_lookups' if blacklist.local else 'dnsbl_queries')
         try:
-            query = '.'.join(reversed(ip.split('.'))) + '.' + self.spamhaus_domain
-            answers = self.resolver.resolve(query, 'A')
-            return True, answers.rrset.to_text()
-        except dns.resolver.NXDOMAIN:
-            return False, "Not listed"
+            return blacklist.query(self.resolver, address, self.negative_ttl)
         except dns.resolver.Timeout:
-            return False, "Timeout"
+            self.metrics.count('dnsbl_timeouts')
+            return False, "Timeout", 0
         except dns.resolver.NoNameservers as e:
-            logging.error(f"DNS resolution error for {ip}: {e}")
-            return False, "DNS resolution error"
+            self.metrics.count('dnsbl_errors')
+            logging.error(f"DNS resolution error for {ip} on {blacklist.name}: {e}")
+            return False, "DNS resolution error", 0
         except dns.exception.DNSException as e:
-            logging.error(f"General DNS error for {ip}: {e}")
-            return False, "General DNS error"
+            self.metrics.count('dnsbl_errors')
+            logging.error(f"General DNS error for {ip} on {blacklist.name}: {e}")
+            return False, "General DNS error", 0
+
+    @staticmethod
+    def _cache_key(blacklist, ip):
+        return f"{blacklist.name}/{ip}"
+
+    def _combine(self, per_list):
+        """
+        Fold the answers of every list into one (is_listed, detail).
+        """
+        if len(per_list) == 1:
+            return next(iter(per_list.values()))
+        listed = [f"{name}: {detail}" for name, (is_listed, detail) in per_list.items() if is_listed]
+        return bool(listed), "; ".join(listed) or "Not listed"
+
+    def check_blacklist(self, ip):
+        """
+        Check if an IP is blacklisted.
+         We ask the blacklist, 'Hey, you seen this guy around here?'.
+        """
+        return self._combine(self.check_blacklists_per_list([ip])[ip])
+
+    def check_blacklists(self, ips):
+        """
+        Check many IPs at once, see check_blacklists_per_list. Returns a dict of ip -> (is_listed, detail),
+        listed on any of the lists.
+        """
+        return {ip: self._combine(per_list) for ip, per_list in self.check_blacklists_per_list(ips).items()}
+
+    def check_blacklists_per_list(self, ips):
+        """
+        Check many IPs against every list: each distinct (list, IP) is queried only once, concurrently,
+        and DNS answers are kept in the TTL cache. Lists with a local zone file are answered in place.
+        Returns a dict of ip -> {list name: (is_listed, detail)}.
+        Asking the bouncer about the same guy a hundred times never made the queue move faster.
+        """
+        with self.metrics.stage('dnsbl'):
+            ips = set(ips)
+            results = {ip: {} for ip in ips}
+            pending = []
+            cache_hits = 0
+            for blacklist in self.blacklists:
+                if blacklist.local:
+                    try:
+                        blacklist.index.refresh()
+                    except OSError as e:
+                        # A missing or half-synced mirror must not take the whole run down with it
+                        self.metrics.count('dnsbl_errors')
+                        if blacklist.index.mtime is None:
+                            logging.error(f"Zone file of {blacklist.name} unavailable, its results are "
+                                          f"errors for this run: {e}")
+                            for ip in ips:
+                                results[ip][blacklist.name] = (False, "Zone file unavailable")
+                            continue
+                        logging.error(f"Zone file of {blacklist.name} unavailable, answering from the copy "
+                                      f"loaded earlier: {e}")
+                    # A bisect per IP, much cheaper than a cache entry
+                    for ip in ips:
+                        results[ip][blacklist.name] = self._query_blacklist(blacklist, ip)[:2]
+                    continue
+                for ip in ips:
+                    cached = self.blacklist_cache.get(self._cache_key(blacklist, ip))
+                    if cached is not None:
+                        results[ip][blacklist.name] = tuple(cached)
+                        cache_hits += 1
+                    else:
+                        pending.append((blacklist, ip))
+            self.metrics.count('dnsbl_cache_hits', cache_hits)
+
+            logging.info(f"Blacklist lookups on {len(self.blacklists)} lists: {cache_hits} cached, "
+                         f"{len(pending)} to resolve with {self.dns_workers} workers")
+            if pending:
+                with ThreadPoolExecutor(max_workers=self.dns_workers) as executor:
+                    futures = {executor.submit(self._query_blacklist, blacklist, ip): (blacklist, ip)
+                               for blacklist, ip in pending}
+                    for future in tqdm(as_completed(futures), total=len(futures), desc="Checking blacklists"):
+                        blacklist, ip = futures[future]
+                        is_listed, detail, ttl = future.result()
+                        self.blacklist_cache.set(self._cache_key(blacklist, ip), [is_listed, detail], ttl)
+                        results[ip][blacklist.name] = (is_listed, detail)
+                self.blacklist_cache.save()
+            # Same order as self.blacklists whatever order the answers came back in
+            return {ip: {blacklist.name: per_list[blacklist.name] for blacklist in self.blacklists}
+                    for ip, per_list in results.items()}
 
     @staticmethod
     def check_spf_alignment(header_from, envelope_from):
@@ -143,46 +270,362 @@ class DMARCAnalyzer:
         except spf.SPFError as e:
             return f"SPF check error: {e}"
 
-    def analyze_reports(self):
+    def get_spf_failure_reasons(self, pairs):
         """
-        Analyze DMARC reports in the given directory.
-        We scan, we parse, we laugh, we cry... it's a whole process.
+        Evaluate SPF for many (ip, envelope_from) pairs. Each distinct pair is checked once,
+        in parallel, and every TXT/A/MX record is fetched once per run through a shared cache.
+        Returns a dict of (ip, envelope_from) -> failure reason.
         """
-        # Scan directory and parse reports
-        logging.info(f"Scanning directory {self.directory} for XML files...")
-        for root, dirs, files in os.walk(self.directory):
-            for file in files:
-                file_path = os.path.join(root, file)
-                if file.endswith('.xml'):
-                    logging.info(f"Parsing {file_path}...")
-                    records = self.parse_dmarc_report(file_path)
-                    self.all_records.extend(records)
-                elif file.endswith('.gz'):
-                    logging.info(f"Extracting {file_path}...")  # Extracting .gz file, because why make it easy?
-                    content = self.extract_gz(file_path)
-                    if content:
-                        logging.info(f"Parsing extracted content from {file_path}...")
-                        records = self.parse_dmarc_report(BytesIO(content))
-                        self.all_records.extend(records)
-                elif file.endswith('.zip'):
-                    logging.info(f"Extracting {file_path}...")  # Unzipping like it's 1999
-                    contents = self.extract_zip(file_path)
-                    for content in contents:
-                        if content:
-                            logging.info(f"Parsing extracted content from {file_path}...")
-                            records = self.parse_dmarc_report(BytesIO(content))
-                            self.all_records.extend(records)
-
-        if self.all_records:
-            df = pd.DataFrame(self.all_records)
+        pairs = list(set(pairs))
+        # pyspf does not hand us TTLs, so a long running process simply starts a fresh cache now and then
+        if self.spf_lookup is None or time.time() - self.spf_lookup_created > self.spf_cache_ttl:
+            self.spf_lookup = CachingSPFLookup()
+            self.spf_lookup_created = time.time()
+        lookup = self.spf_lookup
+        hits, misses = lookup.hits, lookup.misses
+        results = {}
+        start = time.perf_counter()
+        with self.metrics.stage('spf'), lookup.installed(), \
+                ThreadPoolExecutor(max_workers=self.spf_workers) as executor:
+            futures = {executor.submit(self.get_spf_failure_reason, ip, envelope_from): (ip, envelope_from)
+                       for ip, envelope_from in pairs}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Checking SPF"):
+                results[futures[future]] = future.result()
+        elapsed = time.perf_counter() - start
+        hits, misses = lookup.hits - hits, lookup.misses - misses
+        hit_ratio = hits / (hits + misses) if hits + misses else 0.0
+        self.metrics.count('spf_dns_queries', misses)
+        self.metrics.count('spf_cache_hits', hits)
+        # pyspf turns DNS timeouts into a temperror result
+        self.metrics.count('spf_temperrors', sum(reason.startswith('temperror') for reason in results.values()))
+        logging.info(f"SPF stage: {len(pairs)} distinct (ip, domain) pairs in {elapsed:.2f}s, "
+                     f"{misses} DNS queries, cache hit ratio {hit_ratio:.1%}")
+        return results
+
+    def _query_dkim_key(self, name):
+        """
+        Fetch one DKIM key and return (problem, ttl), problem being '' when the key is fine.
+        Errors come back with a ttl of 0 so they are never cached.
+        """
+        self.metrics.count('dkim_dns_queries')
+        try:
+            return fetch_key_problem(self.resolver, name, self.negative_ttl)
+        except dns.resolver.Timeout:
+            self.metrics.count('dkim_dns_errors')
+            return "Key lookup timed out", 0
+        except dns.exception.DNSException as e:
+            self.metrics.count('dkim_dns_errors')
+            logging.error(f"DNS error fetching DKIM key {name}: {e}")
+            return "Key lookup failed", 0
+
+    def get_dkim_failure_reasons(self, signatures):
+        """
+        Explain DKIM failures for many (dkim_domain, dkim_selector, dkim_auth_result, header_from)
+        signatures. Each distinct selector key is fetched once, concurrently, and kept in the TTL cache.
+        Returns a dict of signature -> failure reason.
+        """
+        with self.metrics.stage('dkim'):
+            signatures = set(signatures)
+            names = {key_name(domain, selector) for domain, selector, _, _ in signatures if domain and selector}
+            problems = {}
+            pending = []
+            for name in names:
+                cached = self.dkim_cache.get(name)
+                if cached is not None:
+                    problems[name] = cached
+                else:
+                    pending.append(name)
+            self.metrics.count('dkim_cache_hits', len(problems))
+
+            logging.info(f"DKIM keys: {len(problems)} cached, {len(pending)} to fetch with {self.dns_workers} workers")
+            if pending:
+                with ThreadPoolExecutor(max_workers=self.dns_workers) as executor:
+                    futures = {executor.submit(self._query_dkim_key, name): name for name in pending}
+                    for future in tqdm(as_completed(futures), total=len(futures), desc="Checking DKIM keys"):
+                        name = futures[future]
+                        problem, ttl = future.result()
+                        self.dkim_cache.set(name, problem, ttl)
+                        problems[name] = problem
+                self.dkim_cache.save()
+
+            return {(domain, selector, auth_result, header_from): failure_reason(
+                        domain, selector, auth_result, header_from,
+                        problems.get(key_name(domain, selector), '') if selector else '')
+                    for domain, selector, auth_result, header_from in signatures}
+
+    def ingest_incremental(self, file_paths):
+        """
+        Parse only the files that are new or changed since the last run into the record store,
+        and forget the deleted ones.
+        Why read the same report twice when once was already painful enough?
+        """
+        manifest = ReportManifest(self.manifest_path, self.record_store)
+        try:
+            changed, deleted = manifest.plan(file_paths)
+            manifest.remove(deleted)
+            logging.info(f"{len(changed)} new or changed files to parse, "
+                         f"{len(file_paths) - len(changed)} unchanged")
+            self.metrics.count('files_unchanged', len(file_paths) - len(changed))
+            details = {file_path: (size, mtime, sha256) for file_path, size, mtime, sha256 in changed}
+            for file_path, batch, error, stats in iter_parsed_files(list(details), self.ingest_workers,
+                                                                    self.ingest_chunk_size):
+                self.metrics.record_file(stats)
+                if error:
+                    # Remembered with no records, so it is only retried once the file changes
+                    self.metrics.count('parse_errors')
+                    logging.error(f"Error parsing {file_path}: {error}")
+                manifest.store(file_path, *details[file_path], batch)
+        finally:
+            manifest.close()
+
+    def ingest_attachments(self, attachments):
+        """
+        Parse report attachments as they come off the wire, without reading them back from disk.
+        attachments yields (filename, payload, archive_path) as EmailDownloader.stream_attachments does.
+        In incremental mode the records go straight into the record store, keyed by archive_path
+        when the attachment was archived (so the directory scan sees it as unchanged), otherwise
+        by a stream:// key.
+        """
+        manifest = ReportManifest(self.manifest_path, self.record_store) if self.record_store else None
+        streamed = 0
+        try:
+            for filename, payload, archive_path in attachments:
+                stats = {}
+                try:
+                    batch = read_report_batch(filename, BytesIO(payload), stats)
+                except Exception as e:
+                    self.metrics.count('parse_errors')
+                    logging.error(f"Error parsing attachment {filename}: {type(e).__name__}: {e}")
+                    batch = RecordBatch()
+                self.metrics.record_file(stats)
+                streamed += 1
+                if manifest:
+                    if archive_path:
+                        stat = os.stat(archive_path)
+                        manifest.store(archive_path, stat.st_size, stat.st_mtime, file_digest(archive_path), batch)
+                    else:
+                        manifest.store(STREAM_PREFIX + filename, len(payload), 0,
+                                       hashlib.sha256(payload).hexdigest(), batch)
+                else:
+                    self.all_records.extend(batch)
+                    if archive_path:
+                        self.streamed_paths.add(archive_path)
+        finally:
+            if manifest:
+                manifest.close()
+        logging.info(f"Parsed {streamed} streamed attachments")
+
+    def load_records(self, file_paths):
+        """
+        Bring the records of file_paths in, limited to start_date/end_date when set.
+        Returns (total_records, total_emails, df_failed) so that only the failing records,
+        the ones we actually look at, have to be held in memory in full.
+        """
+        if self.record_store:
+            with self.metrics.stage('ingest'):
+                self.ingest_incremental(file_paths)
+            with self.metrics.stage('dataframe'):
+                # The totals are in the rollup index already, only the failures are read from the store
+                manifest = self._open_rollup()
+                try:
+                    total_records, total_emails = manifest.rollup.totals(self.start_date, self.end_date)
+                finally:
+                    manifest.close()
+                df_failed = self.record_store.read(RECORD_FIELDS, self.start_date, self.end_date,
+                                                   filter=failed_filter())
+            return total_records, total_emails, df_failed
+
+        # Attachments that were streamed in and archived are already in all_records
+        file_paths = [file_path for file_path in file_paths if file_path not in self.streamed_paths]
+        with self.metrics.stage('ingest'):
+            self.all_records.extend(ingest_reports(file_paths, self.ingest_workers, self.ingest_chunk_size,
+                                                   self.metrics))
+        with self.metrics.stage('dataframe'):
+            df = self.all_records.to_frame()
+            if self.start_date or self.end_date:
+                dates = pd.to_datetime(pd.to_numeric(df['report_begin'], errors='coerce'), unit='s').dt.strftime(
+                    '%Y-%m-%d')
+                df = df[(dates >= (self.start_date or '')) & (dates <= (self.end_date or '9999-99-99'))]
 
             # Filter records that fail SPF, DKIM, or both checks
             df_failed = df[(df['spf_result'] == 'fail') | (df['dkim_result'] == 'fail')].copy()
+        return len(df), df['count'].sum(), df_failed
+
+    def _open_rollup(self):
+        if not self.manifest_path:
+            raise ValueError("Trend queries read the rollup index, which is only kept in incremental mode")
+        return ReportManifest(self.manifest_path, self.record_store)
 
+    def failure_trend(self, bucket='day', by=None, start_date=None, end_date=None, **filters):
+        """
+        Messages, failures and failure rate per day, week or month from the rollup index,
+        optionally split by header_from, source_ip, network, spf_result or dkim_result.
+        Only reports ingested by an earlier analyze_reports run are counted.
+        See RollupIndex.trend for the details.
+        """
+        manifest = self._open_rollup()
+        try:
+            return manifest.rollup.trend(bucket, by, start_date or self.start_date, end_date or self.end_date,
+                                         **filters)
+        finally:
+            manifest.close()
+
+    def top_failures(self, by='source_ip', n=10, order='failed', start_date=None, end_date=None, **filters):
+        """
+        The n worst offenders by source_ip, network, header_from, ... from the rollup index.
+        See RollupIndex.top for the details.
+        """
+        manifest = self._open_rollup()
+        try:
+            return manifest.rollup.top(by, n, order, start_date or self.start_date, end_date or self.end_date,
+                                       **filters)
+        finally:
+            manifest.close()
+
+    def enrich_failures(self, df_failed):
+        """
+        Add the blacklist, SPF/DKIM failure reason and SPF alignment columns to df_failed.
+        Lookups are resolved once per distinct key and joined back onto the rows in bulk.
+        """
+        spf_mask = df_failed['spf_result'] == 'fail'
+        spf_pairs = df_failed.loc[spf_mask, ['source_ip', 'envelope_from']].astype(str).drop_duplicates()
+        spf_reasons = self.get_spf_failure_reasons(spf_pairs.itertuples(index=False, name=None))
+        blacklist_results = self.check_blacklists_per_list(df_failed['source_ip'].astype(str).unique())
+
+        # Which lists an IP is on, '' for none; blacklisted is true for any
+        listed_on = pd.Series({ip: ', '.join(name for name, (is_listed, _) in per_list.items() if is_listed)
+                               for ip, per_list in blacklist_results.items()}, dtype=object)
+        listed_on = df_failed['source_ip'].astype(str).map(listed_on).fillna('')
+        df_failed['blacklisted'] = listed_on != ''
+        df_failed['blacklists'] = listed_on
+
+        spf_table = pd.DataFrame([(ip, envelope_from, reason) for (ip, envelope_from), reason in spf_reasons.items()],
+                                 columns=['source_ip', 'envelope_from', 'spf_failure_reason'], dtype=str)
+        df_failed = df_failed.astype({'source_ip': str, 'envelope_from': str}).merge(
+            spf_table, on=['source_ip', 'envelope_from'], how='left')
+        df_failed['spf_failure_reason'] = df_failed['spf_failure_reason'].where(
+            df_failed['spf_result'] == 'fail', '').fillna('')
+
+        dkim_mask = df_failed['dkim_result'] == 'fail'
+        dkim_signatures = df_failed.loc[dkim_mask, list(DKIM_SIGNATURE)].astype(str)
+        dkim_reasons = pd.Series(self.get_dkim_failure_reasons(
+            dkim_signatures.drop_duplicates().itertuples(index=False, name=None)), dtype=object)
+        df_failed['dkim_failure_reason'] = ''
+        if dkim_mask.any():
+            df_failed.loc[dkim_mask, 'dkim_failure_reason'] = dkim_reasons.reindex(
+                pd.MultiIndex.from_frame(dkim_signatures)).values
+
+        header_domains = email_domains(df_failed['header_from'])
+        df_failed['spf_alignment'] = header_domains == email_domains(df_failed['envelope_from'])
+        return df_failed
+
+    def output_writer(self, name):
+        """
+        An OutputWriter for results called name in the current directory, in the configured format.
+        """
+        return OutputWriter(os.path.join(os.getcwd(), name), self.output_format, self.output_compression,
+                            self.output_partitioned, self.output_workers, self.metrics)
+
+    def enrich_and_write(self, df_failed, name):
+        """
+        Enrich df_failed (see enrich_failures) and write it out as results called name, output_chunk_rows
+        rows at a time: while one chunk is written in the background, the lookups for the next one run.
+        Returns the enriched DataFrame and where it was written.
+        """
+        chunks = []
+        with self.output_writer(name) as writer:
+            for start in range(0, len(df_failed), self.output_chunk_rows):
+                chunk = self.enrich_failures(df_failed.iloc[start:start + self.output_chunk_rows].copy())
+                # Convert date range columns to readable format
+                with self.metrics.stage('aggregation'):
+                    chunk['report_begin_readable'] = readable_timestamps(chunk['report_begin'])
+                    chunk['report_end_readable'] = readable_timestamps(chunk['report_end'])
+                writer.write(chunk)
+                chunks.append(chunk)
+        if len(chunks) == 1:
+            return chunks[0], writer.path
+        return pd.concat(chunks, ignore_index=True), writer.path
+
+    @staticmethod
+    def aggregate_failures(df_failed):
+        """
+        Group failures by report period, listing the distinct SPF and DKIM results of each period.
+        """
+        keys = ['report_begin', 'report_end']
+        aggregated_df = df_failed.groupby(keys, as_index=False, observed=True).agg(
+            {'count': 'sum', 'blacklisted': 'max'})
+        for column in ('spf_result', 'dkim_result'):
+            distinct = df_failed[keys + [column]].astype({column: str}).drop_duplicates()
+            joined = distinct.groupby(keys, observed=True)[column].agg(','.join).reset_index()
+            aggregated_df = aggregated_df.merge(joined, on=keys, how='left')
+        aggregated_df = aggregated_df[keys + ['count', 'spf_result', 'dkim_result', 'blacklisted']]
+        aggregated_df['report_begin_readable'] = readable_timestamps(aggregated_df['report_begin'])
+        aggregated_df['report_end_readable'] = readable_timestamps(aggregated_df['report_end'])
+        return aggregated_df
+
+    @staticmethod
+    def describe_report_periods(df_failed):
+        """
+        List the distinct report periods covered, one ' - From: ... To: ...' line each.
+        """
+        ranges = df_failed[['report_begin', 'report_end']].drop_duplicates()
+        texts = []
+        for column in ('report_begin', 'report_end'):
+            readable = readable_timestamps(ranges[column])
+            raw = ranges[column].astype(object).fillna('').astype(str).replace('', "N/A")
+            texts.append(readable.where(readable != "N/A", raw))
+        return "Report Periods Covered:\n" + ''.join(" - From: " + texts[0] + " To: " + texts[1] + "\n")
+
+    @staticmethod
+    def open_files(*file_paths):
+        """
+        Open files with whatever the operating system likes to open them with.
+        """
+        for file_path in file_paths:
+            if platform.system() == 'Windows':
+                os.startfile(file_path)
+            elif platform.system() == 'Darwin':  # macOS
+                subprocess.call(['open', file_path])
+            else:  # Linux and other OS
+                subprocess.call(['xdg-open', file_path])
+
+    def analyze_reports(self, attachments=None, open_results=None):
+        """
+        Analyze DMARC reports in the given directory, plus any attachments streamed in
+        straight from the mailbox (see ingest_attachments).
+        open_results says whether to open the CSV files afterwards; None asks the user.
+        Every stage is timed into self.metrics, and the hooks hear about it as it happens.
+        We scan, we parse, we laugh, we cry... it's a whole process.
+        """
+        self.metrics = RunMetrics(self.hooks)
+        self.metrics.start()
+        try:
+            return self._analyze_reports(attachments, open_results)
+        finally:
+            self.metrics.finish()
+            logging.info(self.metrics.summary())
+
+    def _analyze_reports(self, attachments, open_results):
+        # Start clean, the same analyzer may be asked again and again by a long running process
+        self.all_records = RecordBatch()
+        self.streamed_paths = set()
+        if attachments is not None:
+            logging.info("Parsing attachments while they download...")
+            self.ingest_attachments(attachments)
+
+        # Scan directory and parse reports
+        logging.info(f"Scanning directory {self.directory} for XML files...")
+        with self.metrics.stage('scan'):
+            file_paths = find_report_files(self.directory)
+        logging.info(f"Found {len(file_paths)} report files")
+        total_records, total_emails, df_failed = self.load_records(file_paths)
+        self.metrics.count('records_analyzed', int(total_records))
+        self.metrics.count('records_failed', len(df_failed))
+
+        if total_records:
             if not df_failed.empty:
                 # Analyze the data
                 logging.info("Analyzing DMARC records...")  # Time to do some real work, finally
-                total_emails = df['count'].sum()
                 failed_spf = df_failed[df_failed['spf_result'] == 'fail']['count'].sum()
                 failed_dkim = df_failed[df_failed['dkim_result'] == 'fail']['count'].sum()
                 failed_both = df_failed[(df_failed['spf_result'] == 'fail') & (df_failed['dkim_result'] == 'fail')][
@@ -206,35 +649,11 @@ class DMARCAnalyzer:
                 lost_emails_dkim = failed_dkim - failed_both
                 lost_emails_both = failed_both
 
-                # Calculate total emails lost because of blacklisting
+                # Calculate total emails lost because of blacklisting, and why SPF and DKIM failed
                 logging.info("Checking blacklists for IP addresses...")  # Let's see who's been naughty
-                total_blacklisted_emails = 0
-                df_failed['blacklisted'] = False
-                df_failed['spf_failure_reason'] = ''
-                df_failed['dkim_failure_reason'] = ''
-
-                for index, row in tqdm(df_failed.iterrows(), total=df_failed.shape[0]):
-                    ip = row['source_ip']
-                    spf_failure_reason = ''
-                    dkim_failure_reason = ''
-
-                    if row['spf_result'] == 'fail':
-                        spf_failure_reason = self.get_spf_failure_reason(ip, row['envelope_from'])
-
-                    if row['dkim_result'] == 'fail':
-                        dkim_failure_reason = "Failed DKIM check (details not implemented)"
-
-                    df_failed.at[index, 'spf_failure_reason'] = spf_failure_reason
-                    df_failed.at[index, 'dkim_failure_reason'] = dkim_failure_reason
-
-                    is_listed, _ = self.check_blacklist(ip)
-                    if is_listed:
-                        df_failed.at[index, 'blacklisted'] = True
-                        total_blacklisted_emails += row['count']
-
-                # Check SPF alignment
-                df_failed['spf_alignment'] = df_failed.apply(
-                    lambda x: self.check_spf_alignment(x['header_from'], x['envelope_from']), axis=1)
+                df_failed, output_file = self.enrich_and_write(df_failed, 'dmarc_report_analysis')
+                logging.info(f"Analysis complete. Results saved to {output_file}")
+                total_blacklisted_emails = df_failed.loc[df_failed['blacklisted'], 'count'].sum()
 
                 # Print report
                 summary = (
@@ -247,87 +666,31 @@ class DMARCAnalyzer:
                     f"Total emails lost due to blacklisting: {total_blacklisted_emails}\n"
                 )
 
-                unique_date_ranges = df_failed[['report_begin', 'report_end']].drop_duplicates()
-
-                date_ranges_text = "Report Periods Covered:\n"
-                for _, row in unique_date_ranges.iterrows():
-                    try:
-                        begin_ts = int(row['report_begin']) if row['report_begin'] is not None else None
-                        end_ts = int(row['report_end']) if row['report_end'] is not None else None
-                        begin_str = datetime.fromtimestamp(begin_ts).strftime(
-                            "%Y-%m-%d %H:%M:%S") if begin_ts else "N/A"
-                        end_str = datetime.fromtimestamp(end_ts).strftime("%Y-%m-%d %H:%M:%S") if end_ts else "N/A"
-                    except (ValueError, TypeError):
-                        begin_str = row['report_begin'] or "N/A"
-                        end_str = row['report_end'] or "N/A"
-
-                    date_ranges_text += f" - From: {begin_str} To: {end_str}\n"
-
-                summary += "\n" + date_ranges_text
+                with self.metrics.stage('aggregation'):
+                    summary += "\n" + self.describe_report_periods(df_failed)
 
                 print(summary)
 
                 # Save the summary to a text file
                 summary_file = os.path.join(os.getcwd(), 'summary.txt')
-                with open(summary_file, 'w') as f:
+                with self.metrics.stage('csv_write'), open(summary_file, 'w') as f:
                     f.write(summary)
                 logging.info(f"Summary saved to {summary_file}")
 
-                # Save the dataframe to a CSV file for further analysis if needed
-                output_file = os.path.join(os.getcwd(), 'dmarc_report_analysis.csv')
-                aggregated_output_file = os.path.join(os.getcwd(), 'dmarc_report_analysis_aggregated.csv')
-                # Convert date range columns to readable format if they exist
-                if not df_failed.empty and 'report_begin' in df_failed.columns and 'report_end' in df_failed.columns:
-                    df_failed['report_begin_readable'] = df_failed['report_begin'].apply(
-                        lambda x: datetime.fromtimestamp(int(x)).strftime("%Y-%m-%d %H:%M:%S") if pd.notnull(
-                            x) and x.isdigit() else "N/A"
-                    )
-                    df_failed['report_end_readable'] = df_failed['report_end'].apply(
-                        lambda x: datetime.fromtimestamp(int(x)).strftime("%Y-%m-%d %H:%M:%S") if pd.notnull(
-                            x) and x.isdigit() else "N/A"
-                    )
-
-                df_failed.to_csv(output_file, index=False)
-                logging.info(f"Analysis complete. Results saved to {output_file}")
-
                 # Create an aggregated DataFrame grouped by report_begin and report_end
-                if not df_failed.empty:
-                    aggregation_functions = {
-                        'count': 'sum',
-                        'spf_result': lambda x: ','.join(x.unique()),
-                        'dkim_result': lambda x: ','.join(x.unique()),
-                        'blacklisted': 'max',
-                        # Add other columns and their aggregation as needed
-                    }
-
-                    aggregated_df = df_failed.groupby(['report_begin', 'report_end'], as_index=False).agg(
-                        aggregation_functions)
-
-                    aggregated_df['report_begin_readable'] = aggregated_df['report_begin'].apply(
-                        lambda x: datetime.fromtimestamp(int(x)).strftime("%Y-%m-%d %H:%M:%S") if pd.notnull(x) and str(
-                            x).isdigit() else "N/A"
-                    )
-                    aggregated_df['report_end_readable'] = aggregated_df['report_end'].apply(
-                        lambda x: datetime.fromtimestamp(int(x)).strftime("%Y-%m-%d %H:%M:%S") if pd.notnull(x) and str(
-                            x).isdigit() else "N/A"
-                    )
-
-
-                    aggregated_df.to_csv(aggregated_output_file, index=False)
-                    logging.info(f"Aggregated analysis complete. Results saved to {aggregated_output_file}")
+                with self.metrics.stage('aggregation'):
+                    aggregated_df = self.aggregate_failures(df_failed)
+                with self.output_writer('dmarc_report_analysis_aggregated') as writer:
+                    writer.write(aggregated_df)
+                aggregated_output_file = writer.path
+                logging.info(f"Aggregated analysis complete. Results saved to {aggregated_output_file}")
 
                 # Ask user if they want to open the CSV and Resume file
-                open_csv = input("Do you want to open the CSV and Resume file? (yes/no): ").strip().lower()
-                if open_csv == 'yes':
-                    if platform.system() == 'Windows':
-                        os.startfile(output_file)
-                        os.startfile(aggregated_output_file)
-                    elif platform.system() == 'Darwin':  # macOS
-                        subprocess.call(['open', output_file])
-                        subprocess.call(['open', aggregated_output_file])
-                    else:  # Linux and other OS
-                        subprocess.call(['xdg-open', output_file])
-                        subprocess.call(['open', aggregated_output_file])
+                if open_results is None:
+                    open_csv = input("Do you want to open the CSV and Resume file? (yes/no): ").strip().lower()
+                    open_results = open_csv == 'yes'
+                if open_results:
+                    self.open_files(output_file, aggregated_output_file)
 
                 return df_failed
             else:
@@ -0,0 +1,218 @@
+import heapq
+import ipaddress
+import logging
+import os
+import threading
+from bisect import bisect_right
+import dns.resolver
+
+# Answers in this range are the list telling us off (bad key, public resolver, rate limit), not a listing
+ERROR_ANSWERS = ipaddress.ip_network('127.255.255.0/24')
+
+
+def parse_ip(ip):
+    """
+    Return ip as an ipaddress object, IPv4-mapped IPv6 addresses as the IPv4 they carry,
+    or None when it is not an IP address at all.
+    """
+    try:
+        address = ipaddress.ip_address(ip.strip())
+    except (ValueError, AttributeError):
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+
+def reverse_name(address):
+    """
+    The DNSBL query label of an address: reversed octets for IPv4, reversed nibbles for IPv6.
+    """
+    # reverse_pointer is '4.3.2.1.in-addr.arpa' or 'b.a.9.8. ... .ip6.arpa', drop the last two labels
+    return address.reverse_pointer.rsplit('.', 2)[0]
+
+
+def _parse_network(text):
+    """
+    Turn a zone entry into (version, first, last) as integers. Understands addresses, CIDR
+    networks, 'first-last' ranges and the rbldnsd short forms where '10.1' means 10.1.0.0/16.
+    """
+    if '-' in text:
+        first, last = text.split('-', 1)
+        first = ipaddress.ip_address(first)
+        if last.isdigit() and first.version == 4:
+            # 10.0.0.5-20 is 10.0.0.5 to 10.0.0.20
+            last = ipaddress.ip_address(str(first).rsplit('.', 1)[0] + '.' + last)
+        else:
+            last = ipaddress.ip_address(last)
+        return first.version, int(first), int(last)
+    if ':' not in text and '/' not in text and text.count('.') < 3:
+        octets = text.split('.')
+        text = '.'.join(octets + ['0'] * (4 - len(octets))) + f"/{8 * len(octets)}"
+    network = ipaddress.ip_network(text, strict=False)
+    return network.version, int(network.network_address), int(network.broadcast_address)
+
+
+def _disjoint(entries):
+    """
+    Flatten (first, last, value) entries that may nest into sorted, non-overlapping segments where
+    the most specific entry wins, so that a lookup is a single bisect. A value of None (an
+    exclusion) punches a hole into whatever contains it. Partly overlapping ranges are split.
+    """
+    # On an exact tie the exclusion sorts last, ends up innermost and wins
+    heap = [(first, -last, value is None, order, value) for order, (first, last, value) in enumerate(entries)]
+    heapq.heapify(heap)
+    segments = []
+    stack = []  # (last, value) of the entries containing the current position, innermost last
+    position = None
+
+    def close_until(limit):
+        nonlocal position
+        while stack and stack[-1][0] < limit:
+            last, value = stack.pop()
+            if position <= last:
+                segments.append((position, last, value))
+                position = last + 1
+
+    while heap:
+        first, negative_last, excluded, order, value = heapq.heappop(heap)
+        last = -negative_last
+        close_until(first)
+        if stack:
+            if position < first:
+                segments.append((position, first - 1, stack[-1][1]))
+            if last > stack[-1][0]:
+                # Sticks out of its container, the part outside is dealt with on its own
+                heapq.heappush(heap, (stack[-1][0] + 1, -last, excluded, order, value))
+                last = stack[-1][0]
+        position = first
+        stack.append((last, value))
+    if stack:
+        close_until(float('inf'))
+    return [segment for segment in segments if segment[2] is not None]
+
+
+class ZoneIndex:
+    """
+    A local copy of a DNSBL, loaded from an rbldnsd style zone file (the ip4set, ip4trie and
+    ip6trie formats most lists rsync out) into sorted interval tables, one per address family.
+    A lookup is a bisect, microseconds instead of a DNS round trip.
+
+    Understood lines: '1.2.3.4', '1.2.3.0/24', '1.2.3', '1.2.3.4-1.2.3.20', '2001:db8::/32',
+    each optionally followed by ':127.0.0.x:text'; '!' in front excludes; ':127.0.0.x:text' alone
+    sets the default answer; '#' comments and '$' directives are skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.tables = {4: ([], [], []), 6: ([], [], [])}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        (Re)load the zone file if it changed on disk since the last load, e.g. after an rsync.
+        """
+        with self._lock:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            self.load()
+            self.mtime = mtime
+
+    def load(self):
+        entries = {4: [], 6: []}
+        default = ('127.0.0.2', None)
+        skipped = 0
+        with open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line[0] in '#;$':
+                    continue
+                if line[0] == ':':
+                    answer, _, text = line[1:].partition(':')
+                    default = (answer or default[0], text or None)
+                    continue
+                excluded = line[0] == '!'
+                entry, answer = self._split_answer(line.lstrip('!'))
+                try:
+                    version, first, last = _parse_network(entry)
+                except ValueError:
+                    skipped += 1
+                    continue
+                # The default answer in force at this line, later ':' lines do not change earlier entries
+                entries[version].append((first, last, None if excluded else answer or default))
+
+        for version, version_entries in entries.items():
+            firsts, lasts, answers = [], [], []
+            for first, last, answer in _disjoint(version_entries):
+                firsts.append(first)
+                lasts.append(last)
+                answers.append(answer)
+            self.tables[version] = (firsts, lasts, answers)
+        if skipped:
+            logging.warning(f"Skipped {skipped} unreadable lines in {self.path}")
+        logging.info(f"Loaded {self.path}: {len(self.tables[4][0])} IPv4 and {len(self.tables[6][0])} IPv6 ranges")
+
+    @staticmethod
+    def _split_answer(line):
+        # '1.2.3.4 :127.0.0.3:text', '1.2.3.4:127.0.0.3:text' (IPv4 only) or just '1.2.3.4'
+        head, colon, tail = line.partition(':')
+        if colon and '.' in head:
+            # An IPv6 address never has a dot before its first colon
+            entry, rest = head.strip(), ':' + tail
+        elif ' ' in line or '\t' in line:
+            entry, rest = line.split(None, 1)
+        else:
+            return line, None
+        if not rest.startswith(':'):
+            return entry, None
+        answer, _, text = rest[1:].partition(':')
+        return entry, (answer or '127.0.0.2', text or None)
+
+    def lookup(self, address):
+        """
+        Return the (answer, text) an address is listed with, or None.
+        """
+        firsts, lasts, answers = self.tables[address.version]
+        index = bisect_right(firsts, int(address)) - 1
+        if index >= 0 and int(address) <= lasts[index]:
+            return answers[index]
+        return None
+
+
+class Blacklist:
+    """
+    One DNSBL: queried over DNS at zone, or answered locally from zone_file when there is one.
+    name is what shows up in the results, it defaults to the zone.
+    """
+
+    def __init__(self, zone, name=None, zone_file=None):
+        self.zone = zone.strip('.')
+        self.name = name or self.zone
+        self.index = ZoneIndex(zone_file) if zone_file else None
+
+    @property
+    def local(self):
+        return self.index is not None
+
+    def query(self, resolver, address, negative_ttl):
+        """
+        Look one address up. Returns (is_listed, detail, ttl); errors come back with a ttl of 0
+        so they are never cached. Raises dns.resolver.Timeout and other DNS errors to the caller.
+        """
+        if self.index is not None:
+            found = self.index.lookup(address)
+            if found is None:
+                return False, "Not listed", negative_ttl
+            answer, text = found
+            return True, f"{answer} {text}" if text else answer, negative_ttl
+
+        try:
+            answers = resolver.resolve(f"{reverse_name(address)}.{self.zone}", 'A')
+        except dns.resolver.NXDOMAIN:
+            return False, "Not listed", negative_ttl
+        codes = [rdata.address for rdata in answers]
+        if all(ipaddress.ip_address(code) in ERROR_ANSWERS for code in codes):
+            return False, f"List refused the query ({', '.join(codes)})", 0
+        return True, answers.rrset.to_text(), answers.rrset.ttl
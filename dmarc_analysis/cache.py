@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class TTLCache:
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if it is missing or expired.
+        Stale answers are like stale bread: technically still there, but nobody wants them.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        """
+        Store value under key for ttl seconds. A ttl of zero or less is not cached at all.
+        """
+        if ttl is None or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+
+    def load(self):
+        """
+        Load previously persisted, still valid entries from disk.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable cache {self.path}: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for key, (value, expires) in data.items():
+                if expires >= now:
+                    self._entries[key] = (value, expires)
+        logging.info(f"Loaded {len(self._entries)} cached entries from {self.path}")
+
+    def save(self):
+        """
+        Persist the unexpired entries to disk so the next run starts warm.
+        """
+        if not self.path:
+            return
+        now = time.time()
+        with self._lock:
+            data = {key: [value, expires] for key, (value, expires) in self._entries.items() if expires >= now}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        logging.info(f"Saved {len(data)} cached entries to {self.path}")
@@ -0,0 +1,136 @@
+import base64
+import binascii
+import dns.resolver
+
+# Receivers are free to ignore RSA keys shorter than this (RFC 8301), and most do
+MIN_KEY_BITS = 1024
+
+# Second level labels under which country code TLDs hand out domains, e.g. example.co.uk
+_SECOND_LEVELS = {'ac', 'co', 'com', 'edu', 'gov', 'net', 'org', 'ne', 'or'}
+
+
+def key_name(domain, selector):
+    return f"{selector}._domainkey.{domain}".lower()
+
+
+def organizational_domain(domain):
+    """
+    The registered domain of a host name, e.g. example.com for mail.example.com. Without the
+    public suffix list this is a guess, but a good one for the domains that show up in reports.
+    """
+    labels = domain.lower().strip('.').split('.')
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in _SECOND_LEVELS:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def is_aligned(signing_domain, header_from):
+    """
+    Relaxed DKIM alignment: the signing domain and the From domain share their registered domain.
+    """
+    return organizational_domain(signing_domain) == organizational_domain(header_from)
+
+
+def _der_element(data, position):
+    """
+    Read the DER element at position, return (tag, start of its content, end of its content).
+    """
+    tag = data[position]
+    length = data[position + 1]
+    position += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[position:position + size], 'big')
+        position += size
+    if position + length > len(data):
+        raise ValueError("DER element runs past the end of the key")
+    return tag, position, position + length
+
+
+def rsa_key_bits(der):
+    """
+    The modulus size of an RSA public key, published either as SubjectPublicKeyInfo (the norm)
+    or as a bare PKCS#1 RSAPublicKey (which some signers do anyway).
+    """
+    tag, start, _ = _der_element(der, 0)
+    if tag != 0x30:
+        raise ValueError("Key is not a DER sequence")
+    tag, start, end = _der_element(der, start)
+    if tag == 0x30:
+        # AlgorithmIdentifier, then a BIT STRING wrapping the RSAPublicKey (first byte: unused bits)
+        tag, start, end = _der_element(der, end)
+        if tag != 0x03:
+            raise ValueError("Key has no BIT STRING")
+        tag, start, _ = _der_element(der, start + 1)
+        tag, start, end = _der_element(der, start)
+    if tag != 0x02:
+        raise ValueError("Key has no RSA modulus")
+    return int.from_bytes(der[start:end], 'big').bit_length()
+
+
+def parse_key_record(text):
+    """
+    Split a DKIM key record ('v=DKIM1; k=rsa; p=MIGf...') into a dict of tags.
+    """
+    tags = {}
+    for part in text.split(';'):
+        name, equals, value = part.partition('=')
+        if equals:
+            tags[name.strip().lower()] = ''.join(value.split())
+    return tags
+
+
+def key_problem(records):
+    """
+    Look at the TXT records published for a selector and return what is wrong with the key,
+    or '' when it is usable.
+    """
+    keys = [tags for tags in map(parse_key_record, records) if 'p' in tags]
+    if not keys:
+        return "Missing key"
+    tags = keys[0]
+    if tags.get('v', 'DKIM1') != 'DKIM1':
+        return "Malformed key (v= is not DKIM1)"
+    if not tags['p']:
+        return "Revoked key"
+    key_type = tags.get('k', 'rsa').lower()
+    if key_type != 'rsa':
+        # ed25519 keys are always 256 bits, there is nothing to measure
+        return '' if key_type == 'ed25519' else f"Unsupported key type {key_type}"
+    try:
+        bits = rsa_key_bits(base64.b64decode(tags['p'], validate=True))
+    except (binascii.Error, ValueError, IndexError):
+        return "Malformed key"
+    return f"Key too short ({bits} bits)" if bits < MIN_KEY_BITS else ''
+
+
+def fetch_key_problem(resolver, name, negative_ttl):
+    """
+    Fetch the key published at name and return (problem, ttl), problem being '' for a usable key.
+    DNS errors other than the name not existing are raised to the caller.
+    """
+    try:
+        answers = resolver.resolve(name, 'TXT')
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        return "Missing key", negative_ttl
+    records = [b''.join(rdata.strings).decode('ascii', errors='replace') for rdata in answers]
+    return key_problem(records), answers.rrset.ttl
+
+
+def failure_reason(domain, selector, auth_result, header_from, problem):
+    """
+    Explain a DKIM failure from the signature the receiver saw and what is wrong with its key,
+    if anything. Most telling problem first: no signature, a broken key, a signature by someone
+    else, and only then the signature itself not verifying.
+    """
+    if not domain:
+        return "No DKIM signature"
+    if problem:
+        return f"{problem} at {key_name(domain, selector)}"
+    if not is_aligned(domain, header_from):
+        return f"Misaligned: signed by {domain}, not by {header_from}"
+    if auth_result == 'pass':
+        return f"Signature by {domain} passed but was not counted for {header_from}"
+    if auth_result in ('fail', ''):
+        return f"Signature by {domain} did not verify, the message was probably modified in transit"
+    return f"Receiver could not verify the signature by {domain} ({auth_result})"
@@ -1,20 +1,44 @@
 import os
 import imaplib
-import email
-from email.policy import default
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import logging
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+from dmarc_analysis.imap_parse import decode_part, parse_body_parts, parse_bodystructures
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+REPORT_CONTENT_TYPES = ('application/xml', 'application/gzip', 'application/zip')
+
+# Runs in a row a message the server turns down is asked for again before we give up on it
+MAX_FETCH_ATTEMPTS = 5
+
+
+class FetchRefused(imaplib.IMAP4.error):
+    """
+    The server answered a FETCH with NO or BAD, [UNAVAILABLE] and the like, which may well pass next time.
+    """
+
+
+def _confirm(confirmations):
+    """
+    Wait until the sink has dealt with the attachments it returned confirmations for, see fetch_new_attachments.
+    """
+    for confirm in confirmations:
+        if confirm is not None:
+            confirm()
+
 
 class EmailDownloader:
     def __init__(self, imap_server, email_user, email_pass=None, save_dir=None, use_mfa=False, credentials_json=None,
-                 token_json=None, scopes=None, redirect_uri=None):
+                 token_json=None, scopes=None, redirect_uri=None, mailbox='inbox',
+                 search_criteria='(HEADER Subject "report domain")', state_path=None, connections=4,
+                 batch_size=100, backend='imap', gmail_query='subject:"report domain"', api_workers=8,
+                 gmail_api_url=None):
         self.imap_server = imap_server
         self.email_user = email_user
         self.email_pass = email_pass
@@ -25,8 +49,25 @@ class EmailDownloader:
         self.scopes = [scopes] if scopes else ['https://mail.google.com/']
         self.redirect_uri = redirect_uri
         self.credentials = None
+        self.mailbox = mailbox
+        self.search_criteria = search_criteria
+        self.state_path = state_path
+        self.connections = max(1, connections)
+        self.batch_size = max(1, batch_size)
+        if backend not in ('imap', 'gmail_api'):
+            raise ValueError(f"Unknown email backend {backend}, pick imap or gmail_api")
+        self.backend = backend
+        self.gmail_query = gmail_query
+        self.api_workers = max(1, api_workers)
+        self.gmail_api_url = gmail_api_url
+        self._state_lock = threading.Lock()
 
     def authenticate(self):
+        # The Google auth stack is slow to import and only needed here, app passwords do without it
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+
         creds = None
 
         if os.path.exists(self.token_json):
@@ -44,44 +85,387 @@ class EmailDownloader:
 
         self.credentials = creds
 
-    def download_attachments(self):
+    def connect(self):
+        """
+        Open an IMAP connection, log in and select the mailbox read-only.
+        Returns (connection, uidvalidity).
+        """
+        mail = imaplib.IMAP4_SSL(self.imap_server)
+        if self.use_mfa and self.credentials:
+            mail.login(self.email_user, self.credentials.token)
+        else:
+            mail.login(self.email_user, self.email_pass)
+        result, data = mail.select(self.mailbox, readonly=True)
+        if result != 'OK':
+            raise imaplib.IMAP4.error(f"Failed to select {self.mailbox}: {data}")
+        _, uidvalidity = mail.response('UIDVALIDITY')
+        return mail, uidvalidity[0].decode() if uidvalidity and uidvalidity[0] else None
+
+    @property
+    def _state_key(self):
+        if self.backend == 'gmail_api':
+            return f"gmail:{self.email_user}/{self.mailbox}"
+        return f"{self.email_user}@{self.imap_server}/{self.mailbox}"
+
+    def _load_state_entry(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, 'r') as f:
+            return json.load(f).get(self._state_key, {})
+
+    def load_state(self):
+        """
+        Return (uidvalidity, last_uid, retries) remembered for this mailbox, or (None, 0, {}) the first time.
+        retries maps the UIDs the server refused to the number of runs they have been refused in.
+        """
+        state = self._load_state_entry()
+        retries = {int(uid): attempts for uid, attempts in state.get('retries', {}).items()}
+        return state.get('uidvalidity'), state.get('last_uid', 0), retries
+
+    def save_state(self, uidvalidity, last_uid, retries=None):
+        self._save_state_entry({'uidvalidity': uidvalidity, 'last_uid': last_uid,
+                                'retries': {str(uid): attempts for uid, attempts in sorted((retries or {}).items())}})
+
+    def _save_state_entry(self, entry):
+        if not self.state_path:
+            return
+        with self._state_lock:
+            state = {}
+            if os.path.exists(self.state_path):
+                with open(self.state_path, 'r') as f:
+                    state = json.load(f)
+            state[self._state_key] = entry
+            os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, self.state_path)
+
+    def search_new_uids(self, mail, last_uid):
+        """
+        Return the UIDs above last_uid that match the search criteria, in ascending order.
+        """
+        result, data = mail.uid('SEARCH', f'UID {last_uid + 1}:*', self.search_criteria)
+        if result != 'OK':
+            raise imaplib.IMAP4.error(f"Failed to search emails: {result} {data}")
+        # 'n:*' always matches the newest message, even when it is older than n
+        return sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+
+    def fetch_batch(self, mail, uids):
+        """
+        Fetch the report attachments of a batch of messages: first their BODYSTRUCTURE, then only
+        the attachment body parts, never the whole message. Returns a list of (filename, payload).
+        """
+        uid_set = ','.join(map(str, uids))
+        result, data = mail.uid('FETCH', uid_set, '(UID BODYSTRUCTURE)')
+        if result != 'OK':
+            raise FetchRefused(f"Failed to fetch BODYSTRUCTURE: {result} {data}")
+
+        wanted = {}
+        for uid, parts in parse_bodystructures(data).items():
+            for part, content_type, filename, encoding in parts:
+                if content_type in REPORT_CONTENT_TYPES and filename:
+                    wanted.setdefault(uid, []).append((part, filename, encoding))
+
+        # Messages with the same layout are fetched together, DMARC reports all look alike
+        layouts = {}
+        for uid, parts in wanted.items():
+            layouts.setdefault(tuple(part for part, _, _ in parts), []).append(uid)
+
+        attachments = []
+        for layout, layout_uids in layouts.items():
+            items = ' '.join(f'BODY.PEEK[{part}]' for part in layout)
+            result, data = mail.uid('FETCH', ','.join(map(str, layout_uids)), f'(UID {items})')
+            if result != 'OK':
+                raise FetchRefused(f"Failed to fetch attachments: {result} {data}")
+            bodies = parse_body_parts(data)
+            for uid in layout_uids:
+                for part, filename, encoding in wanted[uid]:
+                    raw = bodies.get(uid, {}).get(part)
+                    if raw is not None:
+                        attachments.append((filename, decode_part(raw, encoding)))
+        return attachments
+
+    def save_attachment(self, filename, payload):
+        """
+        Write an attachment into save_dir and return its path.
+        """
+        filepath = os.path.join(self.save_dir, filename)
+        with open(filepath, 'wb') as f:
+            f.write(payload)
+        logging.info(f"Downloaded {filename}")
+        return filepath
+
+    def _fetch_each(self, mail, uids):
+        """
+        Fetch a batch that failed one message at a time. Returns (attachments, refused UIDs).
+        A message whose answer cannot be parsed or decoded is skipped for good, it would otherwise
+        hold the bookmark back and be retried in vain forever. One the server turned down is
+        handed back to be tried again next run.
+        """
+        attachments = []
+        refused = []
+        for uid in uids:
+            try:
+                attachments.extend(self.fetch_batch(mail, [uid]))
+            except FetchRefused as e:
+                logging.warning(f"Server refused message UID {uid}, it will be retried next run: {e}")
+                refused.append(uid)
+            except (imaplib.IMAP4.abort, OSError):
+                raise
+            except Exception as e:
+                logging.error(f"Skipping message UID {uid}, its attachments could not be decoded: {e}")
+        return attachments, refused
+
+    def _fetch_batches(self, batches, progress, sink):
+        """
+        Worker: fetch a share of the batches over a connection of its own, handing every
+        attachment to sink(filename, payload).
+        Returns (done, refused): the UIDs of the batches that were completely processed, skipped
+        and refused messages included, and the UIDs the server refused.
+        """
+        done = []
+        refused = []
+        # Batches handed to sink, with what it returned to confirm their attachments were dealt with
+        handed = []
+        mail, _ = self.connect()
+        try:
+            for batch in batches:
+                try:
+                    attachments = self.fetch_batch(mail, batch)
+                except (imaplib.IMAP4.abort, OSError):
+                    raise
+                except Exception as e:
+                    # The server turned the batch down, or sent something we could not parse
+                    logging.warning(f"Failed to fetch UIDs {batch[0]}-{batch[-1]} ({e}), trying them one by one")
+                    attachments, batch_refused = self._fetch_each(mail, batch)
+                    refused.extend(batch_refused)
+                handed.append((batch, [sink(filename, payload) for filename, payload in attachments]))
+                progress.update(len(batch))
+        except Exception as e:
+            # The connection is probably gone, keep what we have and let the next run retry the rest
+            logging.error(f"Failed to download attachments: {e}")
+        finally:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+        # Waited for only now, so the next batch is on the wire while the consumer works on this one
+        for batch, confirmations in handed:
+            try:
+                _confirm(confirmations)
+            except Exception as e:
+                logging.error(f"Attachments of UIDs {batch[0]}-{batch[-1]} were not processed: {e}")
+                break
+            done.extend(batch)
+        return done, refused
+
+    def gmail_client(self):
+        """
+        A GmailClient talking to the API with our OAuth credentials, refreshed as they expire.
+        """
+        import requests
+        from google.auth.transport.requests import AuthorizedSession
+        from dmarc_analysis.gmail_api import GMAIL_API_URL, GmailClient
+
+        if self.credentials is None:
+            self.authenticate()
+        session = AuthorizedSession(self.credentials)
+        # One pooled connection per worker, requests keeps only 10 by default
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.api_workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return GmailClient(session, self.gmail_api_url or GMAIL_API_URL)
+
+    def _new_gmail_message_ids(self, client, history_id, synced_at):
         """
-        Connect to an email account and download all DMARC report attachments.
+        The ids of the report messages to fetch: everything matching the query on the first run, or when
+        Gmail has forgotten our history id; otherwise only the messages added since, that match the query.
+        """
+        from dmarc_analysis.gmail_api import HistoryExpired
+
+        query = f"in:{self.mailbox} {self.gmail_query}"
+        if history_id:
+            try:
+                added = client.added_message_ids(history_id)
+            except HistoryExpired:
+                logging.warning("Gmail history expired, looking at every matching message again")
+            else:
+                if not added:
+                    return []
+                # The query cannot be applied to history, so ask it again for the last days only
+                since = f" after:{int(synced_at) - 86400}" if synced_at else ""
+                return [message_id for message_id in client.list_message_ids(query + since) if message_id in added]
+        return list(client.list_message_ids(query))
+
+    def fetch_gmail_attachments(self, sink):
+        """
+        Hand the DMARC report attachments of every message that arrived since the last run to
+        sink(filename, payload), through the Gmail REST API: the message list a page of 500 ids at
+        a time, then api_workers messages and attachments fetched at once. Only messages added
+        since the history id remembered from the last run are looked at.
+        """
+        client = self.gmail_client()
+        state = self._load_state_entry()
+        # Taken before listing, whatever arrives in the meantime is picked up next time
+        history_id = client.profile()['historyId']
+        started = time.time()
+        message_ids = self._new_gmail_message_ids(client, state.get('history_id'), state.get('synced_at'))
+        logging.info(f"{len(message_ids)} new messages" + (f" since history id {state['history_id']}"
+                                                           if state.get('history_id') else ""))
+
+        failed = 0
+        confirmations = []
+        with tqdm(total=len(message_ids), desc="Downloading attachments") as progress, \
+                ThreadPoolExecutor(max_workers=self.api_workers) as executor:
+            futures = {executor.submit(client.message_attachments, message_id, REPORT_CONTENT_TYPES): message_id
+                       for message_id in message_ids}
+            for future in as_completed(futures):
+                try:
+                    for filename, payload in future.result():
+                        confirmations.append(sink(filename, payload))
+                except Exception as e:
+                    failed += 1
+                    logging.error(f"Failed to download attachments of message {futures[future]}: {e}")
+                progress.update(1)
+        try:
+            _confirm(confirmations)
+        except Exception as e:
+            failed += 1
+            logging.error(f"Downloaded attachments were not processed: {e}")
+
+        logging.info(f"Gmail API: {client.requests} requests, {client.retries} retried")
+        if failed:
+            # Keep the old bookmark, the next run looks at the same messages again
+            logging.warning(f"{failed} messages failed, they will be retried next run")
+            return
+        self._save_state_entry({'history_id': history_id, 'synced_at': started})
+
+    def fetch_new_attachments(self, sink):
         """
+        Hand the DMARC report attachments of every message that arrived since the last run
+        to sink(filename, payload), from several connections at once.
+        sink may return a callable that blocks until the attachment has really been dealt with, and
+        raises if it never will be; a message only counts as downloaded once that has returned.
+        """
+        if self.backend == 'gmail_api':
+            try:
+                self.fetch_gmail_attachments(sink)
+            except Exception as e:
+                logging.error(f"Failed to download attachments: {e}")
+            return
+
         if self.use_mfa:
             self.authenticate()
 
         try:
             logging.info(f"Connecting to IMAP server: {self.imap_server}")
-            mail = imaplib.IMAP4_SSL(self.imap_server)
-            if self.use_mfa and self.credentials:
-                mail.login(self.email_user, self.credentials.token)
-            else:
-                mail.login(self.email_user, self.email_pass)
-            mail.select('inbox')
+            mail, uidvalidity = self.connect()
+            known_uidvalidity, last_uid, retries = self.load_state()
+            if known_uidvalidity != uidvalidity:
+                # The server renumbered the mailbox, our bookmark means nothing anymore
+                last_uid = 0
+                retries = {}
+            try:
+                uids = self.search_new_uids(mail, last_uid)
+            finally:
+                mail.logout()
 
-            # Use a more specific and simpler search criteria
-            result, data = mail.search(None, '(HEADER Subject "report domain")')
-            if result != 'OK':
-                logging.error(f"Failed to search emails: {result} {data}")
+            logging.info(f"{len(uids)} new messages since UID {last_uid}"
+                         + (f", {len(retries)} refused earlier to retry" if retries else ""))
+            to_fetch = sorted(set(uids) | set(retries))
+            if not to_fetch:
+                self.save_state(uidvalidity, last_uid)
                 return
 
-            email_ids = data[0].split()
-
-            for email_id in tqdm(email_ids, desc="Downloading attachments"):
-                result, msg_data = mail.fetch(email_id, '(RFC822)')
-                raw_email = msg_data[0][1]
-                msg = email.message_from_bytes(raw_email, policy=default)
+            batches = [to_fetch[i:i + self.batch_size] for i in range(0, len(to_fetch), self.batch_size)]
+            shares = [batches[i::self.connections] for i in range(min(self.connections, len(batches)))]
+            done = set()
+            refused = set()
+            with tqdm(total=len(to_fetch), desc="Downloading attachments") as progress, \
+                    ThreadPoolExecutor(max_workers=len(shares)) as executor:
+                futures = [executor.submit(self._fetch_batches, share, progress, sink) for share in shares]
+                for future in as_completed(futures):
+                    try:
+                        share_done, share_refused = future.result()
+                        done.update(share_done)
+                        refused.update(share_refused)
+                    except Exception as e:
+                        logging.error(f"Failed to download attachments: {e}")
 
-                for part in msg.iter_attachments():
-                    if part.get_content_type() in ['application/xml', 'application/gzip', 'application/zip']:
-                        filename = part.get_filename()
-                        if filename:
-                            filepath = os.path.join(self.save_dir, filename)
-                            with open(filepath, 'wb') as f:
-                                f.write(part.get_payload(decode=True))
-                            logging.info(f"Downloaded {filename}")
-
-            mail.logout()
+            # Retries that were not reached keep their count, refused ones are counted until we give up
+            still_refused = {uid: attempts for uid, attempts in retries.items() if uid not in done}
+            for uid in sorted(refused):
+                attempts = retries.get(uid, 0) + 1
+                if attempts >= MAX_FETCH_ATTEMPTS:
+                    logging.error(f"Giving up on message UID {uid}, the server refused it {attempts} runs in a row")
+                else:
+                    still_refused[uid] = attempts
+            # Only move the bookmark past messages with no gap below them, the rest is retried next run.
+            # Refused messages do not hold it back, they are remembered in retries
+            missing = [uid for uid in uids if uid not in done]
+            self.save_state(uidvalidity, missing[0] - 1 if missing else uids[-1] if uids else last_uid,
+                            still_refused)
         except Exception as e:
             logging.error(f"Failed to download attachments: {e}")
+
+    def download_attachments(self):
+        """
+        Connect to an email account and download all new DMARC report attachments into save_dir.
+        """
+        self.fetch_new_attachments(self.save_attachment)
+
+    def stream_attachments(self, archive=False, queue_size=64):
+        """
+        Yield (filename, payload, archive_path) for every new report attachment while the download
+        is still running, so the caller can parse one attachment while the next is on the wire.
+        At most queue_size attachments wait in memory; the downloaders pause when the queue is full.
+        With archive set, each attachment is also written to save_dir and archive_path is its path,
+        otherwise nothing touches the disk and archive_path is None.
+        """
+        attachments = queue.Queue(maxsize=queue_size)
+        stopped = threading.Event()
+        finished = object()
+
+        def processed(taken):
+            while not taken.wait(0.5):
+                if stopped.is_set():
+                    raise RuntimeError("Attachment consumer went away")
+
+        def sink(filename, payload):
+            archive_path = self.save_attachment(filename, payload) if archive else None
+            # Set once the caller comes back for more, i.e. is done with this attachment. Until then
+            # the message must not count as downloaded: with archive off, this is its only copy
+            taken = threading.Event()
+            while not stopped.is_set():
+                try:
+                    attachments.put((filename, payload, archive_path, taken), timeout=0.5)
+                    return lambda: processed(taken)
+                except queue.Full:
+                    continue
+            raise RuntimeError("Attachment consumer went away")
+
+        def produce():
+            try:
+                self.fetch_new_attachments(sink)
+            finally:
+                attachments.put(finished)
+
+        producer = threading.Thread(target=produce, name="attachment-producer", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = attachments.get()
+                if item is finished:
+                    break
+                filename, payload, archive_path, taken = item
+                yield filename, payload, archive_path
+                taken.set()
+        finally:
+            stopped.set()
+            # Unblock the producer if it is waiting for room to say it has finished
+            while producer.is_alive():
+                try:
+                    attachments.get(timeout=0.5)
+                except queue.Empty:
+                    pass
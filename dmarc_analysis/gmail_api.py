@@ -0,0 +1,164 @@
+import base64
+import logging
+import random
+import threading
+import time
+import requests
+
+GMAIL_API_URL = 'https://gmail.googleapis.com'
+
+# 403s that mean "slow down" rather than "you may not"
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+# messages.get only has to tell us where the attachments are, not hand over the whole message
+MESSAGE_FIELDS = 'id,historyId,payload(partId,mimeType,filename,body,parts)'
+
+
+class GmailAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Gmail API error {status}: {message}")
+        self.status = status
+
+
+class HistoryExpired(GmailAPIError):
+    """
+    The history id we kept is too old for Gmail to remember, a full sync is needed.
+    """
+
+
+def _decode(data):
+    # Gmail hands out URL safe base64, sometimes without the padding
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def report_parts(payload, content_types):
+    """
+    Walk a message payload and yield (filename, body) for every attachment of one of content_types.
+    body has either 'data' (small attachments come inline) or an 'attachmentId' to fetch.
+    """
+    if payload.get('mimeType') in content_types and payload.get('filename'):
+        yield payload['filename'], payload.get('body', {})
+    for part in payload.get('parts', ()):
+        yield from report_parts(part, content_types)
+
+
+class GmailClient:
+    """
+    The handful of Gmail REST calls the downloader needs, over a requests session (an AuthorizedSession
+    in real life). Safe to share between threads. Rate limiting and server hiccups are retried with
+    exponential backoff and jitter, honouring Retry-After when Gmail sends one.
+    """
+
+    def __init__(self, session, api_url=GMAIL_API_URL, user='me', max_retries=6, backoff=1.0, timeout=60):
+        self.session = session
+        self.base_url = f"{api_url.rstrip('/')}/gmail/v1/users/{user}"
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @staticmethod
+    def _error(response):
+        try:
+            error = response.json().get('error', {})
+        except ValueError:
+            return '', response.text[:200]
+        reasons = [item.get('reason', '') for item in error.get('errors', ())]
+        return (reasons[0] if reasons else error.get('status', '')), error.get('message', response.reason)
+
+    def _delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        # Jitter keeps a pool of workers that got throttled together from coming back together
+        return self.backoff * 2 ** attempt * (0.5 + random.random())
+
+    def get(self, path, **params):
+        """
+        GET path (relative to the user) and return the decoded JSON answer.
+        """
+        url = f"{self.base_url}/{path}"
+        for attempt in range(self.max_retries + 1):
+            self._count('requests')
+            response = None
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.debug(f"Retrying {path} after {e}")
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                reason, message = self._error(response)
+                retryable = response.status_code in (429, 500, 502, 503, 504) or \
+                    response.status_code == 403 and reason in RATE_LIMIT_REASONS
+                if response.status_code == 404 and path == 'history':
+                    raise HistoryExpired(response.status_code, message)
+                if not retryable or attempt == self.max_retries:
+                    raise GmailAPIError(response.status_code, message)
+            self._count('retries')
+            time.sleep(self._delay(attempt, response))
+
+    def profile(self):
+        return self.get('profile')
+
+    def list_message_ids(self, query, page_size=500):
+        """
+        Yield the ids of every message matching a Gmail search query, newest first, a page at a time.
+        """
+        page_token = None
+        while True:
+            params = {'q': query, 'maxResults': page_size}
+            if page_token:
+                params['pageToken'] = page_token
+            page = self.get('messages', **params)
+            for message in page.get('messages', ()):
+                yield message['id']
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                return
+
+    def added_message_ids(self, start_history_id):
+        """
+        Return the ids of the messages added to the mailbox since start_history_id.
+        Raises HistoryExpired when Gmail no longer has history that far back.
+        """
+        added = set()
+        page_token = None
+        while True:
+            params = {'startHistoryId': start_history_id, 'historyTypes': 'messageAdded', 'maxResults': 500}
+            if page_token:
+                params['pageToken'] = page_token
+            page = self.get('history', **params)
+            for record in page.get('history', ()):
+                for item in record.get('messagesAdded', ()):
+                    added.add(item['message']['id'])
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                return added
+
+    def get_message(self, message_id):
+        return self.get(f"messages/{message_id}", format='full', fields=MESSAGE_FIELDS)
+
+    def get_attachment(self, message_id, attachment_id):
+        return _decode(self.get(f"messages/{message_id}/attachments/{attachment_id}")['data'])
+
+    def message_attachments(self, message_id, content_types):
+        """
+        Return (filename, payload) for every report attachment of a message.
+        """
+        message = self.get_message(message_id)
+        attachments = []
+        for filename, body in report_parts(message.get('payload', {}), content_types):
+            if 'data' in body:
+                attachments.append((filename, _decode(body['data'])))
+            elif 'attachmentId' in body:
+                attachments.append((filename, self.get_attachment(message_id, body['attachmentId'])))
+        return attachments
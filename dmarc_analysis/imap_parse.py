@@ -0,0 +1,194 @@
+import base64
+import quopri
+import re
+from email.header import decode_header, make_header
+
+FETCH_START = re.compile(rb'^(\d+) \(')
+UID_PATTERN = re.compile(rb'UID (\d+)')
+BODY_PART_PATTERN = re.compile(rb'BODY\[([\d.]+)\](?:<\d+>)? \{\d+\}$')
+LITERAL_PATTERN = re.compile(rb'\{(\d+)\}$')
+
+
+def _tokenize(data):
+    """
+    Split an IMAP response into '(' / ')' markers, strings and atoms. Literals have already been
+    swapped for bytes objects by _flatten, quoted strings are unescaped, NIL becomes None.
+    """
+    tokens = []
+    for chunk in data:
+        if isinstance(chunk, bytes) and chunk[:1] == b'\0':
+            tokens.append(chunk[1:].decode('utf-8', 'replace'))
+            continue
+        i = 0
+        while i < len(chunk):
+            c = chunk[i:i + 1]
+            if c in b' \r\n':
+                i += 1
+            elif c in b'()':
+                tokens.append(c.decode())
+                i += 1
+            elif c == b'"':
+                i += 1
+                value = bytearray()
+                while i < len(chunk) and chunk[i:i + 1] != b'"':
+                    if chunk[i:i + 1] == b'\\':
+                        i += 1
+                    value += chunk[i:i + 1]
+                    i += 1
+                i += 1
+                tokens.append(bytes(value).decode('utf-8', 'replace'))
+            else:
+                start = i
+                while i < len(chunk) and chunk[i:i + 1] not in b' ()\r\n':
+                    i += 1
+                atom = chunk[start:i].decode('utf-8', 'replace')
+                tokens.append(None if atom.upper() == 'NIL' else atom)
+    return tokens
+
+
+def _nest(tokens):
+    stack = [[]]
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) > 1:
+                done = stack.pop()
+                stack[-1].append(done)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def _flatten(response):
+    """
+    Turn imaplib's mix of bytes and (prefix, literal) tuples into a list of byte chunks where
+    each literal is marked with a leading NUL so the tokenizer treats it as a single string.
+    """
+    chunks = []
+    for item in response:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            chunks.append(LITERAL_PATTERN.sub(b'', prefix))
+            chunks.append(b'\0' + literal)
+        elif item is not None:
+            chunks.append(item)
+    return chunks
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {str(key).lower(): val for key, val in zip(value[0::2], value[1::2])}
+
+
+def _decode_filename(name):
+    try:
+        return str(make_header(decode_header(name)))
+    except Exception:
+        return name
+
+
+def iter_body_parts(structure, prefix=''):
+    """
+    Walk a parsed BODYSTRUCTURE and yield (part_number, content_type, filename, encoding)
+    for every leaf part. A message that is not multipart has a single part number '1'.
+    """
+    if structure and isinstance(structure[0], list):
+        # Multipart: the children come first, then the subtype and the extension data
+        for number, child in enumerate(structure, start=1):
+            if not isinstance(child, list):
+                break
+            yield from iter_body_parts(child, f"{prefix}{number}.")
+        return
+
+    content_type = f"{structure[0] or ''}/{structure[1] or ''}".lower()
+    params = _params(structure[2]) if len(structure) > 2 else {}
+    encoding = (structure[5] or '7bit').lower() if len(structure) > 5 else '7bit'
+    filename = None
+    # The disposition sits after the type specific fields, look for ("attachment" ("filename" ...))
+    for field in structure[7:]:
+        if isinstance(field, list) and len(field) == 2 and isinstance(field[0], str) and \
+                isinstance(field[1], list):
+            filename = _params(field[1]).get('filename')
+            if filename:
+                break
+    filename = filename or params.get('name')
+    yield (prefix[:-1] or '1'), content_type, _decode_filename(filename) if filename else None, encoding
+
+
+def parse_bodystructures(response):
+    """
+    Parse the answer to 'UID FETCH ... (BODYSTRUCTURE)' into a dict of uid -> list of parts
+    as yielded by iter_body_parts.
+    """
+    results = {}
+    for message in _split_messages(response):
+        flat = b''.join(chunk if chunk[:1] != b'\0' else b'' for chunk in message)
+        uid_match = UID_PATTERN.search(flat)
+        if not uid_match:
+            continue
+        tree = _nest(_tokenize(message))
+        fetch_items = tree[1] if len(tree) > 1 and isinstance(tree[1], list) else []
+        structure = None
+        for key, value in zip(fetch_items[0::2], fetch_items[1::2]):
+            if isinstance(key, str) and key.upper() == 'BODYSTRUCTURE':
+                structure = value
+        if structure is not None:
+            results[int(uid_match.group(1))] = list(iter_body_parts(structure))
+    return results
+
+
+def _split_messages(response):
+    """
+    Group a FETCH response into one list of chunks per message.
+    """
+    messages = []
+    for chunk in _flatten(response):
+        if chunk[:1] != b'\0' and FETCH_START.match(chunk):
+            messages.append([])
+        if messages:
+            messages[-1].append(chunk)
+    return messages
+
+
+def parse_body_parts(response):
+    """
+    Parse the answer to 'UID FETCH ... (BODY.PEEK[n] ...)' into a dict of uid -> {part: raw bytes}.
+    """
+    results = {}
+    current_seq = None
+    by_seq = {}
+    uids = {}
+    for item in response:
+        prefix = item[0] if isinstance(item, tuple) else item
+        if prefix is None:
+            continue
+        start = FETCH_START.match(prefix)
+        if start:
+            current_seq = int(start.group(1))
+            by_seq.setdefault(current_seq, {})
+        if current_seq is None:
+            continue
+        uid_match = UID_PATTERN.search(prefix)
+        if uid_match:
+            uids[current_seq] = int(uid_match.group(1))
+        if isinstance(item, tuple):
+            part = BODY_PART_PATTERN.search(prefix)
+            if part:
+                by_seq[current_seq][part.group(1).decode()] = item[1]
+    for seq, parts in by_seq.items():
+        if seq in uids:
+            results[uids[seq]] = parts
+    return results
+
+
+def decode_part(data, encoding):
+    """
+    Undo the Content-Transfer-Encoding of an attachment body.
+    """
+    if encoding == 'base64':
+        return base64.b64decode(data)
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
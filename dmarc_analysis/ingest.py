@@ -0,0 +1,86 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from dmarc_analysis.records import RecordBatch, read_report_batch
+
+REPORT_EXTENSIONS = ('.xml', '.gz', '.zip')
+
+# Chunks handed out per worker when there are few files, so a worker that drew the big reports
+# does not leave the others idle
+CHUNKS_PER_WORKER = 4
+
+
+def find_report_files(directory):
+    """
+    Walk directory and return every report file in a stable, sorted order.
+    """
+    file_paths = []
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if file.endswith(REPORT_EXTENSIONS):
+                file_paths.append(os.path.join(root, file))
+    return sorted(file_paths)
+
+
+def parse_chunk(file_paths):
+    """
+    Worker entry point: parse a chunk of files and return (file_path, batch, error, stats) per file,
+    stats being what read_report_file measured. Errors are handed back as text so the parent
+    process does the logging.
+    """
+    results = []
+    for file_path in file_paths:
+        stats = {}
+        try:
+            results.append((file_path, read_report_batch(file_path, stats=stats), None, stats))
+        except Exception as e:
+            results.append((file_path, RecordBatch(), f"{type(e).__name__}: {e}", stats))
+    return results
+
+
+def iter_parsed_files(file_paths, workers=None, chunk_size=16):
+    """
+    Parse file_paths on a pool of worker processes and yield (file_path, batch, error, stats)
+    in the same order as file_paths, whatever order the workers finish in.
+    chunk_size is the most files handed to a worker at a time; fewer files are split finer,
+    so that a handful of big reports still gets every worker.
+    With a single worker everything runs in this process, which is handy for debugging.
+    """
+    if not file_paths:
+        return
+    workers = workers or os.cpu_count() or 1
+    chunk_size = max(1, min(chunk_size, -(-len(file_paths) // (workers * CHUNKS_PER_WORKER))))
+    chunks = [file_paths[i:i + chunk_size] for i in range(0, len(file_paths), chunk_size)]
+    progress = tqdm(total=len(file_paths), desc="Parsing reports")
+    try:
+        if workers == 1 or len(chunks) == 1:
+            results = map(parse_chunk, chunks)
+            for chunk_results in results:
+                progress.update(len(chunk_results))
+                yield from chunk_results
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+                for chunk_results in executor.map(parse_chunk, chunks):
+                    progress.update(len(chunk_results))
+                    yield from chunk_results
+    finally:
+        progress.close()
+
+
+def ingest_reports(file_paths, workers=None, chunk_size=16, metrics=None):
+    """
+    Parse every file and merge the records into one RecordBatch, in file order.
+    A corrupt file is logged and skipped, it does not stop the run.
+    """
+    records = RecordBatch()
+    for file_path, batch, error, stats in iter_parsed_files(file_paths, workers, chunk_size):
+        if metrics:
+            metrics.record_file(stats)
+        if error:
+            if metrics:
+                metrics.count('parse_errors')
+            logging.error(f"Error parsing {file_path}: {error}")
+            continue
+        records.extend(batch)
+    return records
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import sqlite3
+from dmarc_analysis.rollup import TABLES as ROLLUP_TABLES, RollupIndex
+
+# Bump whenever the layout of the manifest or of the record store changes, everything is re-parsed once
+SCHEMA_VERSION = 6
+
+# Reports that were streamed straight from the mailbox have no file on disk, they are keyed like this
+STREAM_PREFIX = 'stream://'
+
+
+def file_digest(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class ReportManifest:
+    def __init__(self, path, record_store):
+        self.path = path
+        self.record_store = record_store
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            logging.info(f"Manifest {path} is missing or outdated, all reports will be parsed again")
+            self.conn.execute("DROP TABLE IF EXISTS records")
+            for table in ROLLUP_TABLES:
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.execute("DROP TABLE IF EXISTS parts")
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.record_store.clear()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sha256 TEXT NOT NULL
+            )""")
+        # The date/org partitions of the record store a file has records in
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS parts (
+                path TEXT NOT NULL REFERENCES files(path),
+                part TEXT NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS parts_path ON parts(path)")
+        self.rollup = RollupIndex(self.conn)
+        self.conn.commit()
+
+    def flush(self):
+        """
+        Write the queued records out, then commit what the manifest knows about them. A crash in
+        between leaves the files unknown to the manifest, so they are simply parsed again.
+        """
+        self.record_store.flush()
+        self.conn.commit()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+    def plan(self, file_paths):
+        """
+        Compare file_paths with what we saw last time.
+        Returns (changed, deleted): changed is a list of (path, size, mtime, sha256) for new or
+        modified files, deleted the paths that have disappeared from disk.
+        Unchanged size and mtime means unchanged file, so most files are never even opened.
+        """
+        known = {path: (size, mtime, sha256) for path, size, mtime, sha256 in
+                 self.conn.execute("SELECT path, size, mtime, sha256 FROM files")}
+        changed = []
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            previous = known.get(file_path)
+            if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+                continue
+            sha256 = file_digest(file_path)
+            if previous and previous[2] == sha256:
+                # Touched but not modified, the stored records are still good
+                self.conn.execute("UPDATE files SET size = ?, mtime = ? WHERE path = ?",
+                                  (stat.st_size, stat.st_mtime, file_path))
+                continue
+            changed.append((file_path, stat.st_size, stat.st_mtime, sha256))
+        self.conn.commit()
+        deleted = sorted(path for path in set(known) - set(file_paths) if not path.startswith(STREAM_PREFIX))
+        return changed, deleted
+
+    def _parts(self, file_path):
+        return [part for part, in self.conn.execute("SELECT part FROM parts WHERE path = ?", (file_path,))]
+
+    def store(self, file_path, size, mtime, sha256, batch):
+        """
+        Replace the records remembered for file_path with the freshly parsed RecordBatch,
+        and move the rollup counts along with them.
+        """
+        old_parts = self._parts(file_path)
+        previous = self.record_store.read_parts(file_path, old_parts) if old_parts else None
+        self.record_store.delete(file_path, old_parts)
+        parts = self.record_store.write(file_path, batch)
+        # Committed by flush(), together with the records
+        if previous is not None:
+            self.rollup.remove(previous)
+        self.rollup.add(batch)
+        self.conn.execute("DELETE FROM parts WHERE path = ?", (file_path,))
+        self.conn.execute("INSERT OR REPLACE INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                          (file_path, size, mtime, sha256))
+        self.conn.executemany("INSERT INTO parts (path, part) VALUES (?, ?)",
+                              ((file_path, part) for part in parts))
+        if self.record_store.pending_rows >= self.record_store.flush_rows:
+            self.flush()
+
+    def remove(self, file_paths):
+        """
+        Forget files that are gone, together with their records.
+        """
+        for file_path in file_paths:
+            parts = self._parts(file_path)
+            self.rollup.remove(self.record_store.read_parts(file_path, parts))
+            self.record_store.delete(file_path, parts)
+            self.conn.execute("DELETE FROM parts WHERE path = ?", (file_path,))
+            self.conn.execute("DELETE FROM files WHERE path = ?", (file_path,))
+        if file_paths:
+            logging.info(f"Dropped records of {len(file_paths)} deleted files")
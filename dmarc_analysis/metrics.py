@@ -0,0 +1,173 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class AnalysisHook:
+    """
+    Base class for anything that wants to watch an analysis run. Override what you need,
+    the rest stays quiet. Hooks are called from the thread running analyze_reports.
+    """
+
+    def run_started(self, metrics):
+        pass
+
+    def stage_started(self, metrics, name):
+        pass
+
+    def stage_finished(self, metrics, name, seconds):
+        pass
+
+    def run_finished(self, metrics):
+        pass
+
+
+class RunMetrics:
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.started = None
+        self.finished = None
+        self.stages = {}
+        self.counters = {}
+        self.details = {}
+        self._lock = threading.Lock()
+
+    def _notify(self, event, *args):
+        for hook in self.hooks:
+            try:
+                getattr(hook, event)(self, *args)
+            except Exception as e:
+                # A broken metrics sink must never take the analysis down with it
+                logging.error(f"Metrics hook {type(hook).__name__} failed in {event}: {e}")
+
+    def start(self):
+        self.started = time.time()
+        self._notify('run_started')
+
+    def finish(self):
+        self.finished = time.time()
+        self._notify('run_finished')
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the with block as stage name. A stage entered twice adds up.
+        """
+        self._notify('stage_started', name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_time(name, seconds)
+            self._notify('stage_finished', name, seconds)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        # DNS workers count from many threads at once
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_file(self, stats):
+        """
+        Account for one parsed report file, from the stats read_report_file filled in.
+        Decompression and parsing run interleaved (and on worker processes), so their times
+        are the sum over files rather than wall clock.
+        """
+        self.add_time('decompress', stats.get('read_seconds', 0.0))
+        self.add_time('parse', stats.get('parse_seconds', 0.0))
+        self.count('files')
+        self.count('records', stats.get('records', 0))
+        self.count('bytes', stats.get('bytes', 0))
+        self.count('bytes_decompressed', stats.get('bytes_decompressed', 0))
+
+    def as_dict(self):
+        return {
+            'started': self.started,
+            'finished': self.finished,
+            'seconds': round((self.finished or time.time()) - self.started, 4) if self.started else None,
+            'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            'counters': dict(self.counters),
+            **self.details
+        }
+
+    def summary(self):
+        stages = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in self.stages.items())
+        counters = ', '.join(f"{name} {value}" for name, value in sorted(self.counters.items()))
+        return f"Stages: {stages or 'none'}. Counters: {counters or 'none'}"
+
+
+class JSONMetricsDump(AnalysisHook):
+    """
+    Write the metrics of every run to path as JSON. A path ending in .jsonl gets one line
+    appended per run instead, handy in daemon mode to see how runs compare over time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def run_finished(self, metrics):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if self.path.endswith('.jsonl'):
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(metrics.as_dict()) + '\n')
+        else:
+            with open(self.path, 'w') as f:
+                json.dump(metrics.as_dict(), f, indent=2)
+        logging.info(f"Metrics saved to {self.path}")
+
+
+class ProfilingHook(AnalysisHook):
+    """
+    Profile a whole run with cProfile and, with memory set, trace allocations with tracemalloc.
+    Writes analysis-<time>.prof (open it with snakeviz or pstats) and, for memory, the peak traced
+    memory of every stage into the metrics plus the top allocation sites into analysis-<time>-memory.txt.
+    cProfile only sees the thread running the analysis; time spent in the DNS and parsing pools
+    shows up as waiting on them. Expect the run to be noticeably slower while profiling.
+    """
+
+    def __init__(self, output_dir, memory=True, top=25):
+        self.output_dir = output_dir
+        self.memory = memory
+        self.top = top
+        self.profiler = None
+
+    def run_started(self, metrics):
+        if self.memory:
+            tracemalloc.start()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stage_started(self, metrics, name):
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def stage_finished(self, metrics, name, seconds):
+        if self.memory and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            metrics.details.setdefault('peak_traced_mb', {})[name] = round(peak / 1e6, 1)
+
+    def run_finished(self, metrics):
+        self.profiler.disable()
+        # Snapshot before dumping the profile, or the profiler's own allocations top the list
+        snapshot = None
+        if self.memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, time.strftime('analysis-%Y%m%d-%H%M%S'))
+        self.profiler.dump_stats(prefix + '.prof')
+        logging.info(f"Profile saved to {prefix}.prof")
+        if snapshot:
+            with open(prefix + '-memory.txt', 'w') as f:
+                for stat in snapshot.statistics('lineno')[:self.top]:
+                    f.write(f"{stat}\n")
+            logging.info(f"Allocation report saved to {prefix}-memory.txt")
@@ -0,0 +1,225 @@
+import gzip
+import logging
+import os
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+
+# What the receiver saw when it checked the message itself: the DKIM signature (the aligned one when
+# there are several) and the SPF identity, empty when the report leaves them out
+AUTH_FIELDS = ('dkim_domain', 'dkim_selector', 'dkim_auth_result', 'spf_domain', 'spf_scope', 'spf_auth_result')
+
+RECORD_FIELDS = ('source_ip', 'count', 'spf_result', 'dkim_result', 'header_from', 'envelope_from',
+                 'report_begin', 'report_end', 'org_name') + AUTH_FIELDS
+
+# What a report says about itself, shared by all of its records
+REPORT_FIELDS = ('org_name', 'report_id', 'report_begin', 'report_end', 'policy_domain', 'policy_adkim',
+                 'policy_aspf', 'policy_p', 'policy_sp', 'policy_pct')
+
+# The part of a record that is its own, the rest comes from the report
+ROW_FIELDS = ('source_ip', 'count', 'spf_result', 'dkim_result', 'header_from', 'envelope_from') + AUTH_FIELDS
+
+# What the rollup index counts messages by, kept here so the command line can offer them without loading pandas
+ROLLUP_KEY_FIELDS = ('day', 'header_from', 'source_ip', 'network', 'spf_result', 'dkim_result')
+
+_POLICY_FIELDS = {'domain': 'policy_domain', 'adkim': 'policy_adkim', 'aspf': 'policy_aspf', 'p': 'policy_p',
+                  'sp': 'policy_sp', 'pct': 'policy_pct'}
+
+
+def _local_name(tag):
+    # Some reporters put everything in a namespace, we only care about the local name
+    return tag.rpartition('}')[2]
+
+
+def _children(elem):
+    return {_local_name(child.tag): child for child in elem}
+
+
+def _text(children, name, default):
+    child = children.get(name)
+    return child.text if child is not None and child.text is not None else default
+
+
+def _aligned(domain, header_from):
+    # Good enough to pick a signature, the DKIM diagnostics do the proper relaxed alignment check
+    domain, header_from = domain.lower(), header_from.lower()
+    return domain == header_from or header_from.endswith('.' + domain) or domain.endswith('.' + header_from)
+
+
+def _auth_results(auth_results, header_from):
+    """
+    Pull the DKIM and SPF identities out of <auth_results> as a tuple in AUTH_FIELDS order.
+    A message can carry several DKIM signatures, the one that matters for DMARC is the one for
+    the header_from domain, so that one is kept if there is one, the first one otherwise.
+    """
+    dkim = spf = None
+    for child in auth_results if auth_results is not None else ():
+        tag = _local_name(child.tag)
+        if tag == 'dkim':
+            fields = _children(child)
+            if dkim is None or not _aligned(dkim[0], header_from) and _aligned(_text(fields, 'domain', ''),
+                                                                               header_from):
+                dkim = (_text(fields, 'domain', ''), _text(fields, 'selector', ''), _text(fields, 'result', ''))
+        elif tag == 'spf' and spf is None:
+            fields = _children(child)
+            spf = (_text(fields, 'domain', ''), _text(fields, 'scope', ''), _text(fields, 'result', ''))
+    return (dkim or ('', '', '')) + (spf or ('', '', ''))
+
+
+def iter_report_records(source):
+    """
+    Stream records out of a DMARC report as (report, row) pairs: report is a tuple in REPORT_FIELDS
+    order, the very same object for every record of the report, and row a tuple in ROW_FIELDS order.
+    Each element is thrown away as soon as it has been read, so memory stays flat
+    no matter how many thousand records Google decided to send us today.
+    """
+    metadata = dict.fromkeys(REPORT_FIELDS)
+    report = None
+    root = None
+    # A report only ever uses a few dozen tags, their local names are worked out once
+    local_names = {}
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+
+        tag = local_names.get(elem.tag)
+        if tag is None:
+            tag = local_names[elem.tag] = _local_name(elem.tag)
+        if tag in ('org_name', 'report_id'):
+            metadata[tag] = elem.text
+            report = None
+        elif tag == 'date_range':
+            date_range = _children(elem)
+            metadata['report_begin'] = _text(date_range, 'begin', None)
+            metadata['report_end'] = _text(date_range, 'end', None)
+            report = None
+        elif tag == 'policy_published':
+            for name, child in _children(elem).items():
+                if name in _POLICY_FIELDS:
+                    metadata[_POLICY_FIELDS[name]] = child.text
+            report = None
+        elif tag == 'record':
+            record = _children(elem)
+            row = record.get('row')
+            row_fields = _children(row) if row is not None else {}
+            policy_evaluated = row_fields.get('policy_evaluated')
+            if policy_evaluated is not None:
+                if report is None:
+                    report = tuple(metadata[field] for field in REPORT_FIELDS)
+                policy = _children(policy_evaluated)
+                identifiers = record.get('identifiers')
+                identifier_fields = _children(identifiers) if identifiers is not None else {}
+                count = row_fields.get('count')
+                header_from = _text(identifier_fields, 'header_from', 'unknown')
+                yield report, (
+                    _text(row_fields, 'source_ip', 'unknown'),
+                    int(count.text) if count is not None else 0,
+                    _text(policy, 'spf', 'none'),
+                    _text(policy, 'dkim', 'none'),
+                    header_from,
+                    _text(identifier_fields, 'envelope_from', 'unknown')
+                ) + _auth_results(record.get('auth_results'), header_from)
+            # Drop everything parsed so far, the root would otherwise keep every record alive
+            root.clear()
+
+
+def flat_record(report, row):
+    """
+    Join a (report, row) pair into one tuple in RECORD_FIELDS order.
+    """
+    return row[:6] + (report[2], report[3], report[0]) + row[6:]
+
+
+class _TimedReader:
+    """
+    Wraps a stream and keeps track of the bytes and time spent reading it. For compressed
+    files that time is the decompression, since gzip and zip inflate inside read().
+    """
+
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        self.stats['read_seconds'] += time.perf_counter() - start
+        self.stats['bytes_decompressed'] += len(data)
+        return data
+
+
+def iter_report_sources(file_path, fileobj=None):
+    """
+    Yield a readable stream for each report inside file_path (.xml, .gz or .zip).
+    Compressed files are decompressed on the fly while the parser reads, nothing is
+    unpacked into memory first. When fileobj is given it is read instead of file_path,
+    which then only tells us what kind of file it is.
+    """
+    if file_path.endswith('.xml'):
+        if fileobj is not None:
+            yield fileobj
+            return
+        with open(file_path, 'rb') as f:
+            yield f
+    elif file_path.endswith('.gz'):
+        with gzip.open(fileobj or file_path, 'rb') as f:
+            yield f
+    elif file_path.endswith('.zip'):
+        with zipfile.ZipFile(fileobj or file_path, 'r') as zip_ref:
+            for name in zip_ref.namelist():
+                if name.endswith('.xml'):
+                    with zip_ref.open(name) as f:
+                        yield f
+
+
+def iter_report_file(file_path, fileobj=None, stats=None):
+    """
+    Yield the (report, row) pairs of every report contained in file_path (or fileobj).
+    Parse and extraction errors are raised to the caller.
+    When a stats dict is given it is filled with bytes, bytes_decompressed, records,
+    read_seconds (reading and decompressing) and parse_seconds.
+    """
+    if stats is None:
+        for source in iter_report_sources(file_path, fileobj):
+            yield from iter_report_records(source)
+        return
+
+    stats.update(bytes=0, bytes_decompressed=0, records=0, read_seconds=0.0, parse_seconds=0.0)
+    start = time.perf_counter()
+    records = 0
+    try:
+        if fileobj is not None:
+            stats['bytes'] = fileobj.getbuffer().nbytes if hasattr(fileobj, 'getbuffer') else 0
+        else:
+            stats['bytes'] = os.path.getsize(file_path)
+        for source in iter_report_sources(file_path, fileobj):
+            for item in iter_report_records(_TimedReader(source, stats)):
+                records += 1
+                yield item
+        stats['records'] = records
+    finally:
+        stats['parse_seconds'] = time.perf_counter() - start - stats['read_seconds']
+
+
+def read_report_file(file_path, fileobj=None, stats=None):
+    """
+    Parse every report contained in file_path (or fileobj) and return the records as a list of
+    flat tuples in RECORD_FIELDS order. See iter_report_file for errors and stats.
+    """
+    return [flat_record(report, row) for report, row in iter_report_file(file_path, fileobj, stats)]
+
+
+def parse_report_file(file_path):
+    """
+    Like read_report_file, but a broken file is logged and contributes no records at all.
+    """
+    try:
+        return read_report_file(file_path)
+    except (ET.ParseError, ValueError):
+        logging.error(f"Error parsing {file_path}")
+        return []
+    except (OSError, EOFError, zipfile.BadZipFile) as e:
+        logging.error(f"Error extracting {file_path}: {e}")
+        return []
@@ -0,0 +1,208 @@
+import ipaddress
+from functools import lru_cache
+from operator import itemgetter
+import numpy as np
+import pandas as pd
+from dmarc_analysis.parser import ROLLUP_KEY_FIELDS
+from dmarc_analysis.store import UNKNOWN_DATE, report_date
+
+# Everything a rollup row is keyed by, and what trend/top queries may group or filter on
+KEY_FIELDS = ROLLUP_KEY_FIELDS
+
+# The same counts at three levels of detail, smallest first. There are about as many distinct
+# (day, source_ip) pairs as there are records, so questions that do not mention the IP are
+# answered from the coarser tables, which only grow with days x domains (x networks).
+TABLES = {
+    'rollup_domain': ('day', 'header_from', 'spf_result', 'dkim_result'),
+    'rollup_network': ('day', 'header_from', 'network', 'spf_result', 'dkim_result'),
+    'rollup': ('day', 'header_from', 'source_ip', 'network', 'spf_result', 'dkim_result'),
+}
+
+BUCKETS = {
+    'day': "day",
+    # Weeks are labelled with their Monday
+    'week': "CASE WHEN day = 'unknown' THEN day ELSE date(day, 'weekday 0', '-6 days') END",
+    'month': "substr(day, 1, 7)",
+}
+
+TOTALS = """
+    SUM(messages) AS messages,
+    SUM(CASE WHEN spf_result = 'fail' OR dkim_result = 'fail' THEN messages ELSE 0 END) AS failed,
+    SUM(CASE WHEN spf_result = 'fail' THEN messages ELSE 0 END) AS spf_failed,
+    SUM(CASE WHEN dkim_result = 'fail' THEN messages ELSE 0 END) AS dkim_failed,
+    SUM(CASE WHEN spf_result = 'fail' AND dkim_result = 'fail' THEN messages ELSE 0 END) AS both_failed"""
+
+
+@lru_cache(maxsize=65536)
+def source_network(ip):
+    """
+    The network a source IP belongs to: its /24 for IPv4, its /64 for IPv6.
+    Senders rotate through neighbouring addresses, the network is what stays put.
+    """
+    head, _, tail = ip.rpartition('.')
+    if head.count('.') == 2 and tail.isdigit() and ':' not in head:
+        # Plain IPv4, which is most of them, without the ipaddress round trip
+        return f"{head}.0/24"
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    return str(ipaddress.ip_network(f"{address}/{24 if address.version == 4 else 64}", strict=False))
+
+
+def rollup_rows(batch):
+    """
+    Collapse a RecordBatch into {table: {key: (messages, records)}}, one entry per table
+    in TABLES with its key in that table's field order.
+    """
+    report_codes, begins = batch.value_codes('report_begin')
+    # Every record of a report shares its day, so days are worked out once per report
+    days = {}
+    report_days = np.asarray([days.setdefault(report_date(begin), len(days)) for begin in begins], dtype=np.intc)
+    day_values = list(days)
+
+    fields = ('header_from', 'source_ip', 'spf_result', 'dkim_result')
+    coded = [batch.value_codes(field) for field in fields]
+    keys = np.stack([report_days[report_codes]] + [codes for codes, _ in coded], axis=1)
+    # The detailed key of every record as one row of codes, summed per distinct row
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    messages = np.bincount(inverse, weights=batch.column('count'), minlength=len(unique))
+    records = np.bincount(inverse, minlength=len(unique))
+
+    tables = {table: {} for table in TABLES}
+    projections = [(tables[table], itemgetter(*(KEY_FIELDS.index(field) for field in table_fields)))
+                   for table, table_fields in TABLES.items()]
+    (_, header_froms), (_, source_ips), (_, spf_results), (_, dkim_results) = coded
+    for (day, header_from, source_ip, spf_result, dkim_result), row_messages, row_records in zip(
+            unique.tolist(), messages.tolist(), records.tolist()):
+        ip = source_ips[source_ip]
+        values = (day_values[day], header_froms[header_from], ip, source_network(ip), spf_results[spf_result],
+                  dkim_results[dkim_result])
+        for rows, project in projections:
+            key = project(values)
+            total_messages, total_records = rows.get(key, (0, 0))
+            rows[key] = (total_messages + int(row_messages), total_records + row_records)
+    return tables
+
+
+def _primary_key(fields):
+    # network follows from source_ip, it is not part of the key where both are present
+    return [field for field in fields if field != 'network' or 'source_ip' not in fields]
+
+
+class RollupIndex:
+    """
+    Message counts per day, header_from domain, source IP (and network) and SPF/DKIM outcome,
+    kept next to the manifest and updated as reports come and go, so trend questions over
+    a year of reports never have to touch the records themselves.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        for table, fields in TABLES.items():
+            self.conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {', '.join(f'{field} TEXT NOT NULL' for field in fields)},
+                    messages INTEGER NOT NULL,
+                    records INTEGER NOT NULL,
+                    PRIMARY KEY ({', '.join(_primary_key(fields))})
+                ) WITHOUT ROWID""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS rollup_by_domain ON rollup(header_from, day)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS rollup_by_network ON rollup(network, day)")
+
+    def add(self, batch, sign=1):
+        """
+        Add the records of a RecordBatch to the counts, or take them off again with sign=-1.
+        Runs inside the caller's transaction.
+        """
+        for table, rows in rollup_rows(batch).items():
+            fields = TABLES[table]
+            self.conn.executemany(f"""
+                INSERT INTO {table} ({', '.join(fields)}, messages, records)
+                VALUES ({', '.join('?' * (len(fields) + 2))})
+                ON CONFLICT ({', '.join(_primary_key(fields))}) DO UPDATE SET
+                    messages = messages + excluded.messages,
+                    records = records + excluded.records""",
+                ((*key, sign * messages, sign * records)
+                 for key, (messages, records) in rows.items()))
+            if sign < 0:
+                self.conn.execute(f"DELETE FROM {table} WHERE records <= 0")
+
+    def remove(self, batch):
+        self.add(batch, -1)
+
+    @staticmethod
+    def _table(fields):
+        """
+        The smallest rollup table that has every one of fields.
+        """
+        for table, table_fields in TABLES.items():
+            if set(fields) <= set(table_fields):
+                return table
+
+    @staticmethod
+    def _where(start_date, end_date, filters):
+        clauses, params = [], []
+        if start_date or end_date:
+            # 'unknown' would pass day >= start_date, undated reports are outside any date range
+            clauses.append("day != ?")
+            params.append(UNKNOWN_DATE)
+        if start_date:
+            clauses.append("day >= ?")
+            params.append(start_date)
+        if end_date:
+            clauses.append("day <= ?")
+            params.append(end_date)
+        for field, value in filters.items():
+            if field not in KEY_FIELDS:
+                raise ValueError(f"Cannot filter on {field}, pick one of {', '.join(KEY_FIELDS)}")
+            if value is not None:
+                clauses.append(f"{field} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    @staticmethod
+    def _with_rate(df):
+        df['failure_rate'] = (df['failed'] / df['messages'].where(df['messages'] > 0)).fillna(0.0)
+        return df
+
+    def totals(self, start_date=None, end_date=None):
+        """
+        Return (records, messages) over the reports starting between start_date and end_date.
+        """
+        where, params = self._where(start_date, end_date, {})
+        records, messages = self.conn.execute(
+            f"SELECT SUM(records), SUM(messages) FROM rollup_domain{where}", params).fetchone()
+        return records or 0, messages or 0
+
+    def trend(self, bucket='day', by=None, start_date=None, end_date=None, **filters):
+        """
+        Messages and failures per day, week or month, optionally split by one of KEY_FIELDS.
+        filters narrow things down, e.g. header_from='example.com' or network='192.0.2.0/24'.
+        Returns a DataFrame ordered by bucket.
+        """
+        if bucket not in BUCKETS:
+            raise ValueError(f"Unknown bucket {bucket}, pick one of {', '.join(BUCKETS)}")
+        if by is not None and by not in KEY_FIELDS:
+            raise ValueError(f"Cannot group by {by}, pick one of {', '.join(KEY_FIELDS)}")
+        where, params = self._where(start_date, end_date, filters)
+        table = self._table([field for field in [by, *filters] if field])
+        group = "bucket" + (f", {by}" if by else "")
+        query = f"SELECT {BUCKETS[bucket]} AS bucket{', ' + by if by else ''},{TOTALS} " \
+                f"FROM {table}{where} GROUP BY {group} ORDER BY {group}"
+        return self._with_rate(pd.read_sql_query(query, self.conn, params=params))
+
+    def top(self, by='source_ip', n=10, order='failed', start_date=None, end_date=None, **filters):
+        """
+        The n values of by (one of KEY_FIELDS) with the most failed messages, or whatever
+        order names: messages, failed, spf_failed, dkim_failed or both_failed.
+        """
+        if by not in KEY_FIELDS:
+            raise ValueError(f"Cannot group by {by}, pick one of {', '.join(KEY_FIELDS)}")
+        if order not in ('messages', 'failed', 'spf_failed', 'dkim_failed', 'both_failed'):
+            raise ValueError(f"Cannot order by {order}")
+        where, params = self._where(start_date, end_date, filters)
+        table = self._table([by, *filters])
+        query = f"SELECT {by},{TOTALS} FROM {table}{where} GROUP BY {by} ORDER BY {order} DESC, {by} LIMIT ?"
+        return self._with_rate(pd.read_sql_query(query, self.conn, params=params + [int(n)]))
@@ -0,0 +1,55 @@
+import threading
+from contextlib import contextmanager
+import spf
+
+
+class CachingSPFLookup:
+    def __init__(self, lookup=None):
+        self.lookup = lookup or spf.DNSLookup
+        self.hits = 0
+        self.misses = 0
+        self._results = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, qtype, tcpfallback=True, timeout=30):
+        """
+        Drop-in replacement for spf.DNSLookup that answers each (name, qtype) only once per run.
+        Threads asking for a record that is already being fetched wait for that answer instead
+        of sending their own query. Temporary errors are not cached, so the next caller retries.
+        """
+        key = (name.lower(), qtype)
+        while True:
+            with self._lock:
+                if key in self._results:
+                    self.hits += 1
+                    return self._results[key]
+                event = self._inflight.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self._inflight[key] = threading.Event()
+                    break
+            # Either the answer is cached now, or the fetching thread failed and we try ourselves
+            event.wait()
+
+        try:
+            result = self.lookup(name, qtype, tcpfallback, timeout)
+            with self._lock:
+                self._results[key] = result
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    @contextmanager
+    def installed(self):
+        """
+        Make pyspf resolve through this cache for the duration of the with block.
+        """
+        original = spf.DNSLookup
+        spf.DNSLookup = self
+        try:
+            yield self
+        finally:
+            spf.DNSLookup = original
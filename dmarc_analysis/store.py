@@ -0,0 +1,258 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+from datetime import datetime, timezone
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from dmarc_analysis.parser import AUTH_FIELDS, RECORD_FIELDS, REPORT_FIELDS
+from dmarc_analysis.records import RecordBatch
+
+# What a report says about itself beyond RECORD_FIELDS (its id and published policy). Stored with every
+# record, dictionary-encoded that is a few bytes per report, and read back with read(columns=...)
+REPORT_DETAIL_FIELDS = tuple(field for field in REPORT_FIELDS if field not in RECORD_FIELDS)
+
+STORED_FIELDS = RECORD_FIELDS + REPORT_DETAIL_FIELDS
+
+# Columns with only a handful of distinct values are stored dictionary-encoded and come back as categoricals
+DICTIONARY_FIELDS = ('spf_result', 'dkim_result', 'header_from', 'envelope_from', 'org_name') + AUTH_FIELDS + \
+    REPORT_DETAIL_FIELDS
+
+SCHEMA = pa.schema([
+    (field, pa.int64() if field == 'count'
+     else pa.dictionary(pa.int32(), pa.string()) if field in DICTIONARY_FIELDS
+     else pa.string())
+    for field in STORED_FIELDS
+])
+
+PARTITIONING = ds.partitioning(pa.schema([('date', pa.string()), ('org', pa.string())]), flavor='hive')
+
+# Every partition is one file, records keep the key of the report file they came from so that
+# the partition can be rewritten without them when that file changes or goes away
+SOURCE_FIELD = 'source'
+FILE_SCHEMA = SCHEMA.append(pa.field(SOURCE_FIELD, pa.dictionary(pa.int32(), pa.string())))
+PART_FILE = 'records.parquet'
+
+# The date partition of reports without a usable date_range. Sorts after every real date, so date
+# bounds have to leave it out explicitly
+UNKNOWN_DATE = 'unknown'
+
+# Records held back before the touched partitions are rewritten, about 100 MB of Arrow
+FLUSH_ROWS = 1000000
+
+
+def report_date(begin):
+    """
+    Turn a report_begin timestamp into the YYYY-MM-DD partition it belongs to.
+    """
+    try:
+        return datetime.fromtimestamp(int(begin), tz=timezone.utc).strftime('%Y-%m-%d')
+    except (TypeError, ValueError, OverflowError, OSError):
+        return UNKNOWN_DATE
+
+
+def partition_name(value):
+    return re.sub(r'[^A-Za-z0-9._-]', '_', value) if value else 'unknown'
+
+
+def batch_table(batch):
+    """
+    Turn a RecordBatch into an Arrow table in SCHEMA. Dictionary columns are built straight
+    from the batch's codes, the other strings with a single take.
+    """
+    arrays = []
+    for field in STORED_FIELDS:
+        if field == 'count':
+            arrays.append(pa.array(batch.column('count'), pa.int64()))
+            continue
+        codes, values = batch.value_codes(field)
+        indices, dictionary = _null_indices(codes, values)
+        if field in DICTIONARY_FIELDS:
+            arrays.append(pa.DictionaryArray.from_arrays(indices, dictionary))
+        else:
+            arrays.append(dictionary.take(indices))
+    return pa.Table.from_arrays(arrays, schema=SCHEMA)
+
+
+def _null_indices(codes, values):
+    """
+    Arrow indices and dictionary for codes into values. A missing value (an optional report field
+    left out, an empty element) becomes a null index: Parquet cannot write a null inside a dictionary.
+    """
+    if None not in values:
+        return pa.array(codes, pa.int32()), pa.array(values, pa.string())
+    present = [value is not None for value in values]
+    remap = np.cumsum(present, dtype=np.int32) - 1
+    indices = remap[codes]
+    missing = ~np.asarray(present)[codes]
+    indices[missing] = 0
+    dictionary = pa.array([value for value in values if value is not None], pa.string())
+    return pa.array(indices, pa.int32(), mask=missing), dictionary
+
+
+class RecordStore:
+    """
+    Parsed records in Parquet, one file per date/org partition. Writes and deletes are held back
+    and applied per partition by flush(), so a run that adds a thousand small reports rewrites
+    each touched partition once instead of leaving a thousand small files behind to scan forever.
+    """
+
+    def __init__(self, root, flush_rows=FLUSH_ROWS):
+        self.root = root
+        self.flush_rows = flush_rows
+        # partition -> {source: table waiting to be added}, and the sources whose stored records go away
+        self._pending = {}
+        self._dropped = {}
+        self.pending_rows = 0
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def _file_key(file_path):
+        return hashlib.sha1(file_path.encode('utf-8')).hexdigest()
+
+    def _part_path(self, partition):
+        return os.path.join(self.root, partition, PART_FILE)
+
+    def write(self, file_path, batch):
+        """
+        Queue the RecordBatch parsed from file_path for the date/org partitions its reports belong to,
+        replacing whatever was stored for file_path there before. Returns the partitions written to,
+        relative to the store root. Nothing reaches the disk before flush().
+        """
+        source = self._file_key(file_path)
+        report_codes, begins = batch.value_codes('report_begin')
+        _, org_names = batch.value_codes('org_name')
+        # Partitions are decided once per report, then handed down to its records
+        partitions = {}
+        report_partitions = np.asarray([
+            partitions.setdefault((report_date(begin), partition_name(org_name)), len(partitions))
+            for begin, org_name in zip(begins, org_names)], dtype=np.intc)
+        record_partitions = report_partitions[report_codes]
+
+        table = batch_table(batch)
+        written = []
+        for (date, org), partition in sorted(partitions.items()):
+            rows = table.take(np.flatnonzero(record_partitions == partition))
+            sources = pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(rows), dtype=np.int32)), [source])
+            name = os.path.join(f"date={date}", f"org={org}")
+            self._drop(name, source)
+            self._pending.setdefault(name, {})[source] = rows.append_column(FILE_SCHEMA.field(SOURCE_FIELD), sources)
+            written.append(name)
+        self.pending_rows += len(batch)
+        return written
+
+    def _drop(self, partition, source):
+        self._dropped.setdefault(partition, set()).add(source)
+        # The same file written twice before a flush, the last version wins
+        self._pending.get(partition, {}).pop(source, None)
+
+    def delete(self, file_path, partitions):
+        """
+        Queue the removal of the records of file_path from partitions.
+        """
+        source = self._file_key(file_path)
+        for partition in partitions:
+            self._drop(partition, source)
+
+    def _read_part(self, partition):
+        path = self._part_path(partition)
+        if not os.path.exists(path):
+            return None
+        # Not pq.read_table, it would see the hive folders and add date and org columns
+        return pq.ParquetFile(path).read()
+
+    def read_parts(self, file_path, partitions):
+        """
+        Read the records stored for file_path in partitions back as a RecordBatch, queued changes included.
+        """
+        source = self._file_key(file_path)
+        tables = []
+        for partition in partitions:
+            # Once dropped, what the file on disk has for source is history
+            if source not in self._dropped.get(partition, ()):
+                table = self._read_part(partition)
+                if table is not None:
+                    tables.append(table.filter(pc.equal(_sources(table), source)))
+            if source in self._pending.get(partition, {}):
+                tables.append(self._pending[partition][source])
+        if not tables:
+            return RecordBatch()
+        return RecordBatch.from_columns(pa.concat_tables(tables).select(list(STORED_FIELDS)).to_pydict())
+
+    def flush(self):
+        """
+        Rewrite every partition with queued changes: the records it has, minus the dropped sources,
+        plus the queued ones. The new files are all written before any of them replaces an old one.
+        """
+        replaced = []
+        for partition in sorted(set(self._pending) | set(self._dropped)):
+            tables = []
+            existing = self._read_part(partition)
+            if existing is not None:
+                dropped = pa.array(sorted(self._dropped.get(partition, ())), pa.string())
+                tables.append(existing.filter(pc.invert(pc.is_in(_sources(existing), value_set=dropped))))
+            tables.extend(self._pending.get(partition, {}).values())
+            table = pa.concat_tables(tables).unify_dictionaries().combine_chunks() if tables else None
+            path = self._part_path(partition)
+            if table is None or not table.num_rows:
+                replaced.append((None, path))
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Dot files are skipped by dataset discovery, a crash here leaves nothing half written to read
+            new = os.path.join(os.path.dirname(path), '.' + PART_FILE)
+            pq.write_table(table, new)
+            replaced.append((new, path))
+        for new, path in replaced:
+            if new:
+                os.replace(new, path)
+            elif os.path.exists(path):
+                os.remove(path)
+        self._pending.clear()
+        self._dropped.clear()
+        self.pending_rows = 0
+        if replaced:
+            logging.debug(f"Rewrote {len(replaced)} partitions of {self.root}")
+
+    def clear(self):
+        self._pending.clear()
+        self._dropped.clear()
+        self.pending_rows = 0
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    def read(self, columns=None, start_date=None, end_date=None, filter=None):
+        """
+        Read records back as a DataFrame, touching only the requested columns (any of STORED_FIELDS,
+        RECORD_FIELDS by default) and the date partitions between start_date and end_date
+        (YYYY-MM-DD, both inclusive).
+        filter is an extra pyarrow expression pushed down into the scan.
+        """
+        dataset = ds.dataset(self.root, format='parquet', partitioning=PARTITIONING, schema=FILE_SCHEMA.append(
+            pa.field('date', pa.string())).append(pa.field('org', pa.string())))
+        expression = filter
+        if start_date or end_date:
+            # Like the in-memory path, a report that has no date is outside any date range
+            expression = _and(expression, ds.field('date') != UNKNOWN_DATE)
+        if start_date:
+            expression = _and(expression, ds.field('date') >= start_date)
+        if end_date:
+            expression = _and(expression, ds.field('date') <= end_date)
+        table = dataset.to_table(columns=list(columns or RECORD_FIELDS), filter=expression)
+        logging.info(f"Read {table.num_rows} records from {self.root}")
+        return table.to_pandas()
+
+
+def _sources(table):
+    return table[SOURCE_FIELD].cast(pa.string())
+
+
+def _and(left, right):
+    return right if left is None else left & right
+
+
+def failed_filter():
+    return (ds.field('spf_result') == 'fail') | (ds.field('dkim_result') == 'fail')
@@ -1,55 +1,250 @@
 import os
+import argparse
 import configparser
-from dmarc_analysis.analyzer import DMARCAnalyzer
+import logging
+import signal
+import threading
 from dmarc_analysis.downloader import EmailDownloader
+from dmarc_analysis.metrics import JSONMetricsDump, ProfilingHook
+from dmarc_analysis.parser import ROLLUP_KEY_FIELDS as KEY_FIELDS
 
-# Load configuration
-config = configparser.ConfigParser()
-config.read(os.path.join(os.path.dirname(__file__), 'config/config.ini'))
-
-spamhaus_query_key = config.get('spamhaus', 'query_key')
-spamhaus_domain = config.get('spamhaus', 'domain')
-spamhaus_full_domain = f"{spamhaus_query_key}.{spamhaus_domain}"
-imap_server = config.get('email', 'imap_server')
-email_user = config.get('email', 'email_user')
-email_pass = config.get('email', 'email_pass')
-use_mfa = config.getboolean('email', 'use_mfa')
-credentials_json = config.get('email', 'credentials_json')
-token_json = config.get('email', 'token_json')
-scopes = config.get('email', 'scopes')
-redirect_uri = config.get('email', 'redirect_uri')
-
-print("")
-print("ATTENTION: saying 'no' to the next question will make")
-print("the script look for files inside the dmarc_checks folder")
-print("")
-# Ask user if they want to download DMARC reports from email
-download_from_email = input("Do you want to download DMARC reports from an email account? (yes/no): ").strip().lower()
-if download_from_email == 'yes':
-    download_dir = 'dmarc_check'
-    os.makedirs(download_dir, exist_ok=True)
-    if use_mfa:
-        email_downloader = EmailDownloader(
-            imap_server,
-            email_user,
-            save_dir=download_dir,
-            use_mfa=use_mfa,
-            credentials_json=credentials_json,
-            token_json=token_json,
-            scopes=scopes,
-            redirect_uri=redirect_uri
-        )
-    else:
-        email_downloader = EmailDownloader(
-            imap_server,
-            email_user,
-            email_pass,
-            save_dir=download_dir,
-            use_mfa=use_mfa
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), 'config/config.ini')
+DOWNLOAD_DIR = 'dmarc_check'
+
+
+def load_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def build_downloader(config):
+    """
+    Create the EmailDownloader described by the [email] section.
+    """
+    cache_dir = config.get('analysis', 'cache_dir', fallback='cache')
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    options = dict(
+        save_dir=DOWNLOAD_DIR,
+        use_mfa=config.getboolean('email', 'use_mfa'),
+        mailbox=config.get('email', 'mailbox', fallback='inbox'),
+        state_path=os.path.join(cache_dir, 'imap_state.json'),
+        connections=config.getint('email', 'connections', fallback=4),
+        batch_size=config.getint('email', 'batch_size', fallback=100),
+        backend=config.get('email', 'backend', fallback='imap'),
+        gmail_query=config.get('email', 'gmail_query', fallback='subject:"report domain"'),
+        api_workers=config.getint('email', 'api_workers', fallback=8)
+    )
+    # The Gmail API only takes OAuth tokens, no app passwords there
+    if options['use_mfa'] or options['backend'] == 'gmail_api':
+        return EmailDownloader(
+            config.get('email', 'imap_server'),
+            config.get('email', 'email_user'),
+            credentials_json=config.get('email', 'credentials_json'),
+            token_json=config.get('email', 'token_json'),
+            scopes=config.get('email', 'scopes'),
+            redirect_uri=config.get('email', 'redirect_uri'),
+            **options
         )
-    email_downloader.download_attachments()
+    return EmailDownloader(
+        config.get('email', 'imap_server'),
+        config.get('email', 'email_user'),
+        config.get('email', 'email_pass'),
+        **options
+    )
+
+
+def build_blacklists(config):
+    """
+    The DNSBLs described by the [spamhaus] and [blacklists] sections, Spamhaus first.
+    """
+    from dmarc_analysis.blacklist import Blacklist
+    spamhaus_domain = config.get('spamhaus', 'domain')
+    zones = [spamhaus_domain] + [zone.strip() for zone in config.get('blacklists', 'lists', fallback='').split(',')
+                                 if zone.strip()]
+    zone_files = {}
+    for entry in config.get('blacklists', 'zone_files', fallback='').split(','):
+        if entry.strip():
+            zone, _, path = entry.partition('=')
+            zone_files[zone.strip()] = path.strip()
+
+    blacklists = []
+    for zone in dict.fromkeys(zones):
+        # The DQS key is part of the zone queried, it stays out of the results and the cache
+        query_zone = f"{config.get('spamhaus', 'query_key')}.{zone}" if zone == spamhaus_domain else zone
+        blacklists.append(Blacklist(query_zone, name=zone, zone_file=zone_files.get(zone)))
+    return blacklists
+
+
+def build_analyzer(config, start_date=None, end_date=None, metrics_file=None, profile_dir=None):
+    """
+    Create the DMARCAnalyzer described by the [spamhaus], [blacklists], [analysis] and [output] sections.
+    """
+    # pandas, pyarrow and dnspython take most of a second to import, only pay for them when analyzing
+    from dmarc_analysis.analyzer import DMARCAnalyzer
+    hooks = []
+    metrics_file = metrics_file or config.get('analysis', 'metrics_file', fallback='')
+    if metrics_file:
+        hooks.append(JSONMetricsDump(metrics_file))
+    if profile_dir:
+        hooks.append(ProfilingHook(profile_dir))
+    spamhaus_query_key = config.get('spamhaus', 'query_key')
+    spamhaus_domain = config.get('spamhaus', 'domain')
+    cache_dir = config.get('analysis', 'cache_dir', fallback='cache')
+    incremental = config.getboolean('analysis', 'incremental', fallback=True)
+    return DMARCAnalyzer(
+        DOWNLOAD_DIR,
+        f"{spamhaus_query_key}.{spamhaus_domain}",
+        dns_workers=config.getint('analysis', 'dns_workers', fallback=16),
+        blacklist_cache_path=os.path.join(cache_dir, 'blacklist.json'),
+        dkim_cache_path=os.path.join(cache_dir, 'dkim.json'),
+        negative_ttl=config.getint('analysis', 'negative_ttl', fallback=3600),
+        spf_workers=config.getint('analysis', 'spf_workers', fallback=8),
+        ingest_workers=config.getint('analysis', 'ingest_workers', fallback=0) or None,
+        ingest_chunk_size=config.getint('analysis', 'ingest_chunk_size', fallback=16),
+        manifest_path=os.path.join(cache_dir, 'manifest.sqlite') if incremental else None,
+        store_dir=os.path.join(cache_dir, 'records'),
+        start_date=start_date or config.get('analysis', 'start_date', fallback='') or None,
+        end_date=end_date or config.get('analysis', 'end_date', fallback='') or None,
+        hooks=hooks,
+        blacklists=build_blacklists(config),
+        output_format=config.get('output', 'format', fallback='csv'),
+        output_compression=config.get('output', 'compression', fallback='none'),
+        output_chunk_rows=config.getint('output', 'chunk_rows', fallback=250000),
+        output_partitioned=config.getboolean('output', 'partitioned', fallback=False),
+        output_workers=config.getint('output', 'workers', fallback=0) or None
+    )
+
+
+def fetch_reports(config, downloader, stream):
+    """
+    Download new reports. When streaming, return the attachment stream for the analyzer instead.
+    """
+    if stream:
+        # Parse while downloading, the attachments never have to be read back from disk
+        return downloader.stream_attachments(archive=config.getboolean('email', 'archive', fallback=True))
+    downloader.download_attachments()
+    return None
+
+
+def run_daemon(config, analyzer, downloader, stream, interval):
+    """
+    Fetch and analyze every interval seconds until told to stop. The analyzer, its resolver,
+    its DNS caches and the record store stay loaded between cycles, and thanks to the manifest
+    and the IMAP bookmark each cycle only deals with reports that are new.
+    """
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    cycle = 0
+    while not stop.is_set():
+        cycle += 1
+        logging.info(f"Starting cycle {cycle}")
+        try:
+            attachments = fetch_reports(config, downloader, stream) if downloader else None
+            analyzer.analyze_reports(attachments, open_results=False)
+        except Exception as e:
+            logging.exception(f"Cycle {cycle} failed: {e}")
+        logging.info(f"Cycle {cycle} done, next one in {interval} seconds")
+        stop.wait(interval)
+    logging.info("Stopping, bye!")
+
+
+def interactive(config):
+    """
+    The original question and answer flow, for when no subcommand is given.
+    """
+    print("")
+    print("ATTENTION: saying 'no' to the next question will make")
+    print("the script look for files inside the dmarc_checks folder")
+    print("")
+    attachments = None
+    # Ask user if they want to download DMARC reports from email
+    download_from_email = input(
+        "Do you want to download DMARC reports from an email account? (yes/no): ").strip().lower()
+    if download_from_email == 'yes':
+        attachments = fetch_reports(config, build_downloader(config),
+                                    config.getboolean('email', 'streaming', fallback=False))
+
+    # Analyze DMARC reports
+    build_analyzer(config).analyze_reports(attachments)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download and analyze DMARC aggregate reports. "
+                                                 "Without a command, asks what to do.")
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help="path to config.ini")
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('fetch', help="download new reports from the mailbox into dmarc_check")
+
+    analyze = commands.add_parser('analyze', help="analyze the reports in dmarc_check")
+    run = commands.add_parser('run', help="fetch new reports, then analyze")
+    for command in (analyze, run):
+        command.add_argument('--open', action='store_true', help="open the CSV files when done")
+        command.add_argument('--start-date', help="only reports starting on or after this date (YYYY-MM-DD)")
+        command.add_argument('--end-date', help="only reports starting on or before this date (YYYY-MM-DD)")
+        command.add_argument('--metrics', help="write stage timings and counters to this JSON file "
+                                               "(.jsonl appends one line per run)")
+        command.add_argument('--profile', metavar='DIR', help="profile the run with cProfile and tracemalloc, "
+                                                              "reports go to DIR")
+
+    run.add_argument('--no-fetch', action='store_true', help="skip the mailbox, only analyze")
+    run.add_argument('--stream', action=argparse.BooleanOptionalAction, default=None,
+                     help="parse attachments while they download (default: [email] streaming)")
+    run.add_argument('--daemon', action='store_true', help="keep running, one cycle every --interval seconds")
+    run.add_argument('--interval', type=int, default=3600, help="seconds between daemon cycles (default: 3600)")
+
+    trend = commands.add_parser('trend', help="messages and failures over time, from the rollup index")
+    trend.add_argument('--bucket', choices=('day', 'week', 'month'), default='day')
+    trend.add_argument('--by', choices=KEY_FIELDS, help="split every bucket by this field")
+    top = commands.add_parser('top', help="the worst senders, domains or networks, from the rollup index")
+    top.add_argument('--by', choices=KEY_FIELDS, default='source_ip')
+    top.add_argument('-n', type=int, default=10, help="how many to show (default: 10)")
+    top.add_argument('--order', choices=('messages', 'failed', 'spf_failed', 'dkim_failed', 'both_failed'),
+                     default='failed')
+    for command in (trend, top):
+        command.add_argument('--start-date', help="only reports starting on or after this date (YYYY-MM-DD)")
+        command.add_argument('--end-date', help="only reports starting on or before this date (YYYY-MM-DD)")
+        command.add_argument('--header-from', help="only mail claiming to be from this domain")
+        command.add_argument('--network', help="only mail from this network, e.g. 192.0.2.0/24")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = load_config(args.config)
+
+    if args.command is None:
+        interactive(config)
+    elif args.command == 'fetch':
+        build_downloader(config).download_attachments()
+    elif args.command == 'analyze':
+        analyzer = build_analyzer(config, args.start_date, args.end_date, args.metrics, args.profile)
+        analyzer.analyze_reports(open_results=args.open)
+    elif args.command in ('trend', 'top'):
+        analyzer = build_analyzer(config, args.start_date, args.end_date)
+        filters = {'header_from': args.header_from, 'network': args.network}
+        if args.command == 'trend':
+            result = analyzer.failure_trend(args.bucket, args.by, **filters)
+        else:
+            result = analyzer.top_failures(args.by, args.n, args.order, **filters)
+        if result.empty:
+            print("Nothing in the rollup index for that, has 'analyze' run yet (with incremental = true)?")
+        else:
+            print(result.to_string(index=False))
+    elif args.command == 'run':
+        analyzer = build_analyzer(config, args.start_date, args.end_date, args.metrics, args.profile)
+        downloader = None if args.no_fetch else build_downloader(config)
+        stream = config.getboolean('email', 'streaming', fallback=False) if args.stream is None else args.stream
+        if args.daemon:
+            run_daemon(config, analyzer, downloader, stream, args.interval)
+        else:
+            attachments = fetch_reports(config, downloader, stream) if downloader else None
+            analyzer.analyze_reports(attachments, open_results=args.open)
+
 
-# Analyze DMARC reports
-directory = 'dmarc_check'
-dmarc_analyzer = DMARCAnalyzer(directory, spamhaus_full_domain)
-dmarc_analyzer.analyze_reports()
+# Parsing runs on worker processes, which re-import this module on Windows and macOS
+if __name__ == '__main__':
+    main()